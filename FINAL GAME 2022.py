@@ -1,9 +1,18 @@
 # This game was written by Maarya Siddiqui on Jan 19th 2022
 # This game is called Run Kirby Run! :)
 
-import pygame, os, random, time
+import pygame, os, random, time, math, json, argparse, multiprocessing, struct, zlib, tempfile, csv
+import queue, threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
 from pygame.locals import *
 
+# numpy is only needed for the bot environments
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # set up window size
 WINDOWWIDTH = 900
 WINDOWHEIGHT = 700
@@ -11,21 +20,199 @@ WINDOWHEIGHT = 700
 # set up the colours
 PINK = (255, 105, 180)
 
-# set up the frame rate
+# set up the frame rate. The game's speeds are measured in pixels per frame
+# at this rate
 FRAMERATE = 60
 
+# the number of physics steps per second
+SIMRATE = 60
+
+# how fast the player runs and jumps and how hard gravity pulls, in pixels
+# per frame. The player runs through the level as fast as the original game
+# scrolled the world past them
+RUNSPEED = 5
+JUMPSPEED = -13
+GRAVITY = 0.35
+
+# the size the player is drawn and collides at
+PLAYERSIZE = (90, 80)
+
+# the most frames' worth of physics steps run to catch up before a frame is
+# drawn
+MAXFRAMESKIP = 5
+
 # Ground where Kirby runs
 GROUND = 565
 
 # Max background parameter
 MAXBG = 8000
 
+# the width of a background tile and how many tiles are kept in memory
+TILEWIDTH = 512
+TILECACHE = 6
+
 # the number of time before a new creature/powerup is added
 NEWITEMS = 5
 
 # the number of creatures when the game begins
 INITIALITEMS = 2
 
+# the most creatures, and the most stars, that can be in the world at once
+MAXITEMS = 8
+
+# the level played unless another one is chosen
+LEVELFILE = 'level1.json'
+
+# how far past the edges of the window the level is loaded
+CHUNKMARGIN = 600
+
+# the width of a chunk of an endless level, how many chunks ahead of the window
+# are generated early and how many generated chunks are remembered
+ENDLESSCHUNK = 1200
+ENDLESSLOOKAHEAD = 2
+ENDLESSCACHE = 8
+
+# the widest gap and the highest step in an endless level. The player's jump
+# (-13 with 0.35 gravity) rises about 240 pixels and, running at 5 pixels a
+# frame, crosses about 350, so these leave room
+MAXGAP = 260
+MAXSTEP = 150
+
+# the number of entities of each kind the batch entity engine has room for
+BATCHCAPACITY = 1024
+
+# replay files start with this, followed by the game's options
+REPLAYMAGIC = b'KIRBYRP2'
+
+# a recorded event is the number of steps run before it, its type and its key.
+# Steps are counted from the start of the game and don't go back when it is
+# restarted or rewound. The file ends with the final state, as the steps run,
+# the game's physics step, points, lives and x and y position, and a checksum
+# of everything before it
+REPLAYEVENT = struct.Struct('<IBI')
+REPLAYSTATE = struct.Struct('<IIiiii')
+REPLAYCHECKSUM = struct.Struct('<I')
+
+# the event types that are recorded, and the type saved in the file for each
+REPLAYEVENTS = {KEYDOWN: 0, KEYUP: 1}
+
+# called with no arguments before the game exits, for saving things like replays
+EXIT_HOOKS = []
+
+# the scales the benchmarks run at, as multiples of the level's platforms and
+# coins and of the creatures in the world
+BENCHSCALES = (1, 10, 100)
+
+# the physics steps timed at each scale, and the games started to time startup
+BENCHSTEPS = 600
+BENCHSTARTS = 5
+
+# what the benchmarks time, in the order they are reported
+BENCHPHASES = ('startup', 'process_events', 'update_sprites', 'run_logic', 'display_frame',
+               'platforms_near', 'gravity', 'horizontal_collision', 'vertical_collisions',
+               'sense_contacts')
+
+# a benchmark whose median is more than this many times its baseline's is slower
+BENCHTOLERANCE = 1.25
+
+# the baseline the benchmarks are compared with when no other is given
+BENCHBASELINE = 'benchmark_baseline.json'
+
+# the parts of a frame the profiler times, in the order they happen
+PROFILEPHASES = ('process_events', 'update_sprites', 'run_logic', 'display_frame', 'tick')
+
+# the sprite groups and collision grids the profiler counts, by the name shown
+# for each
+PROFILEGROUPS = (('sprites', 'all_sprites'), ('platforms', 'platform_index'),
+                 ('plants', 'plant_index'), ('coins', 'coin_list'),
+                 ('creatures', 'creatures'), ('stars', 'powerup'))
+
+# the entity batches that hold the same things as a group in batch mode
+PROFILEBATCHES = {'coins': 'coin_batch', 'creatures': 'creature_batch', 'stars': 'star_batch'}
+
+# the number of frames the profiler remembers, and how many the overlay's FPS
+# is averaged over
+PROFILEFRAMES = 3600
+PROFILEFPSFRAMES = 30
+
+# the key that shows and hides the profiler overlay
+PROFILEKEY = K_F3
+
+# how many seconds the ending plays before the winning or game over screen
+# takes over, while the screen fades in
+WINTRANSITION = 5
+LOSETRANSITION = 2
+
+# the rewind buffer keeps a snapshot of the game every REWINDSTEP seconds for
+# the last REWINDSECONDS seconds. Each press of REWINDKEY goes back one snapshot,
+# and RESTARTKEY starts the game over without going back to the menu
+REWINDSTEP = 1
+REWINDSECONDS = 10
+REWINDKEY = K_BACKSPACE
+RESTARTKEY = K_r
+
+# the sprite images packed together into one atlas surface, at the size they
+# are drawn. Each is packed facing right and facing left
+ATLASFRAMES = (('pink_kirby.png', PLAYERSIZE), ('creature.png', (50,50)),
+               ('star.png', (60,50)), ('coin.png', (50,50)))
+
+# the key that outlines the level's platforms, plants and winning block, and
+# the colour each is outlined in
+GEOMETRYKEY = K_F4
+GEOMETRYCOLOURS = (('platform_index', (0, 0, 255)), ('plant_index', (255, 0, 0)),
+                   ('win_index', (255, 215, 0)))
+
+# the images and sounds decoded in the background while the menu is shown, the
+# number of threads that decode them, and how often, in milliseconds, the menu
+# checks on them
+PRELOADIMAGES = ('Background_updated.png', 'controls_image.png', 'credits-game.png',
+                 'winning_screen.png', 'gameover_screen.png', 'pink_kirby.png',
+                 'creature.png', 'star.png', 'coin.png')
+PRELOADSOUNDS = ('pickup.wav', 'game_over(losing).wav', 'game_over(winning).wav',
+                 'jump.wav', 'level_up.wav', 'plant_collision_sound.wav')
+PRELOADWORKERS = 4
+PRELOADWAIT = 50
+
+# navigation graphs are saved next to their level with this extension, and
+# checking an endless level looks at this many chunks from the start
+NAVEXTENSION = '.nav.json'
+NAVCHUNKS = 20
+
+# set up frame capture: captures ending in CAPTURERAW are one raw RGB video
+# stream, anything else is a folder of numbered CAPTURENAME images. At most
+# CAPTUREQUEUE frames (about 2.5 MB each) wait to be written
+CAPTURERAW = '.raw'
+CAPTURENAME = 'frame%06d.png'
+CAPTUREQUEUE = 30
+
+# the size of a cell in the collision grid
+GRIDCELL = 128
+
+# the keys held down for each action a bot can take
+ACTIONS = [(), (K_LEFT,), (K_RIGHT,), (K_UP,), (K_LEFT, K_UP), (K_RIGHT, K_UP)]
+
+# how many of the nearest creatures a bot can see
+OBSERVEDCREATURES = 3
+
+# how far ahead and behind the player a bot can see
+OBSERVEDRANGE = WINDOWWIDTH
+
+# the screens the game can show and the images of the still ones
+MENU = 'menu'
+CONTROLS = 'controls'
+CREDITS = 'credits'
+PLAYING = 'playing'
+SCREENIMAGES = {MENU: 'opening_screen.png',
+                CONTROLS: 'controls_image.png',
+                CREDITS: 'credits-game.png'}
+
+# the events each screen listens for
+MENUEVENTS = [QUIT, KEYDOWN, MOUSEBUTTONUP, VIDEOEXPOSE]
+GAMEEVENTS = [QUIT, KEYDOWN, KEYUP]
+
+# how long the menus sleep waiting for an event, in milliseconds
+MENUWAIT = 500
+
 def scrollLeft(anobject, speed):
     """This function allows an object to move left"""
     anobject.x_change = -speed
@@ -38,27 +225,82 @@ def stop_scrolling(anobject):
     """This function stops an object from moving"""
     anobject.x_change = 0
 
-def gravity(anobject, platforms):
-    """This function implements gravity in the game"""
-    # if the player is not jumping
-    if anobject.y_change == 0:
+def move_x(anobject, distance):
+    """This function moves an object sideways by a distance that can be a fraction
+        of a pixel. The fractions are saved up until they add up to a whole pixel"""
+    anobject.x_fraction += distance
+    whole = int(anobject.x_fraction)
+    anobject.x_fraction -= whole
+    anobject.rect.x += whole
+
+def move_y(anobject, distance):
+    """This function moves an object up or down by a distance that can be a fraction
+        of a pixel"""
+    anobject.y_fraction += distance
+    whole = int(anobject.y_fraction)
+    anobject.y_fraction -= whole
+    anobject.rect.y += whole
+
+def gravity(anobject, dt=1.0):
+    """This function implements gravity in the game. dt is the length of the physics
+        step in frames. Whether the object is standing on something comes from the
+        contacts sensed at the end of the last step"""
+    # See if we are on the ground.
+    if anobject.grounded and anobject.y_change >= 0:
+        anobject.y_change = 0
+    # if the object has just stepped off an edge, it starts to fall
+    elif anobject.y_change == 0:
         anobject.y_change = 1
     # if the player is jumping, implement gravity
     else:
-        anobject.y_change += 0.35
-
-    block_hit_list = pygame.sprite.spritecollide(anobject, platforms, False)
-    for block in block_hit_list:
-        # See if we are on the ground.
-        if anobject.rect.y >= block.rect.top - anobject.rect.height and anobject.y_change >= 0:
-            anobject.y_change = 0
-            anobject.rect.y = block.rect.top - anobject.rect.height
-
-def vertical_collisions(anobject, platforms):
+        anobject.y_change += GRAVITY * dt
+
+def platforms_near(anobject, platforms, dx, dy):
+    """This function returns the area an object can reach this physics step, moving
+        by dx and dy, and the platforms in it. It is the one collision query an
+        object makes each step, and the collision checks after it only look at
+        the platforms it found"""
+    reach = anobject.rect.union(anobject.rect.move(int(dx), int(dy))).inflate(4, 4)
+    return reach, platforms.query(reach)
+
+def touching(anobject, blocks):
+    """This function returns the blocks an object overlaps"""
+    return [block for block in blocks if anobject.rect.colliderect(block.rect)]
+
+def sense_contacts(anobject, blocks):
+    """This function works out which sides of an object rest against a block and
+        saves them on the object as grounded, ceiling, wall_left and wall_right"""
+    rect = anobject.rect
+    anobject.grounded = anobject.ceiling = False
+    anobject.wall_left = anobject.wall_right = False
+    for block in blocks:
+        other = block.rect
+        # blocks above or below that it overlaps sideways
+        if other.left < rect.right and other.right > rect.left:
+            if other.top == rect.bottom:
+                anobject.grounded = True
+            elif other.bottom == rect.top:
+                anobject.ceiling = True
+        # blocks to either side that it overlaps up and down
+        if other.top < rect.bottom and other.bottom > rect.top:
+            if other.right == rect.left:
+                anobject.wall_left = True
+            elif other.left == rect.right:
+                anobject.wall_right = True
+
+def sense_after_move(anobject, platforms, reach, blocks):
+    """This function senses an object's contacts at the end of a step. The blocks
+        found at the start of the step are used, unless a collision pushed the
+        object out of the area they were found in"""
+    if not reach.contains(anobject.rect.inflate(2, 2)):
+        blocks = platforms.query(anobject.rect.inflate(2, 2))
+    sense_contacts(anobject, blocks)
+
+def vertical_collisions(anobject, blocks):
     """This function checks for vertical collisions between an object
         and platforms"""
     # See if we hit anything in the vertical plane
-    block_hit_list = pygame.sprite.spritecollide(anobject, platforms, False)
+    block_hit_list = touching(anobject, blocks)
     for block in block_hit_list:
         # Reset our position based on the top/bottom of the object.
         if anobject.y_change > 0:
@@ -68,12 +310,13 @@ def vertical_collisions(anobject, platforms):
 
         # Stop our vertical movement
         anobject.y_change = 0
+        anobject.y_fraction = 0
 
-def horizontal_collision(anobject, platforms):
+def horizontal_collision(anobject, blocks):
     """This function checks for horizontal collision between an object
         and platforms"""
     # See if we hit anything in the horizontal plane
-    block_hit_list = pygame.sprite.spritecollide(anobject, platforms, False)
+    block_hit_list = touching(anobject, blocks)
     for block in block_hit_list:
         # If we are moving right,
         # set our right side to the left side of the item we hit
@@ -83,19 +326,97 @@ def horizontal_collision(anobject, platforms):
             # Otherwise if we are moving left, do the opposite.
             anobject.rect.left = block.rect.right
     
+class SpatialGrid():
+    """A uniform grid that buckets sprites by their world position, so a collision
+        check only looks at the sprites in the cells it overlaps"""
+    def __init__(self, sprites=(), cell_size=GRIDCELL):
+        self.cell_size = cell_size
+
+        # maps a cell (column, row) to the sprites that overlap it
+        self.cells = {}
+
+        # maps a sprite to the cells it is stored in
+        self.sprite_cells = {}
+
+        for sprite in sprites:
+            self.insert(sprite)
+
+    def __len__(self):
+        return len(self.sprite_cells)
+
+    def __iter__(self):
+        return iter(list(self.sprite_cells))
+
+    def cells_for(self, rect):
+        """This function returns the cells a world rect overlaps"""
+        size = self.cell_size
+        return [(column, row)
+                for column in range(rect.left // size, (rect.right - 1) // size + 1)
+                for row in range(rect.top // size, (rect.bottom - 1) // size + 1)]
+
+    def insert(self, sprite):
+        """This function adds a sprite to the grid"""
+        keys = self.cells_for(sprite.rect)
+        self.sprite_cells[sprite] = keys
+        for key in keys:
+            self.cells.setdefault(key, []).append(sprite)
+
+    def remove(self, sprite):
+        """This function takes a sprite out of the grid"""
+        for key in self.sprite_cells.pop(sprite, ()):
+            cell = self.cells[key]
+            cell.remove(sprite)
+            if not cell:
+                del self.cells[key]
+
+    def move(self, sprite):
+        """This function re-buckets a sprite after it has moved"""
+        keys = self.cells_for(sprite.rect)
+        if keys != self.sprite_cells.get(sprite):
+            self.remove(sprite)
+            self.insert(sprite)
+
+    def query(self, rect):
+        """This function returns the sprites that collide with a world rect"""
+        found = []
+        seen = set()
+        for key in self.cells_for(rect):
+            for sprite in self.cells.get(key, ()):
+                if sprite not in seen:
+                    seen.add(sprite)
+                    if sprite.rect.colliderect(rect):
+                        found.append(sprite)
+        return found
+
+    def spritecollide(self, sprite, dokill=False):
+        """This function works like pygame.sprite.spritecollide but only checks
+            nearby sprites. If dokill is True the hit sprites are removed from the
+            grid and killed"""
+        hit_list = self.query(sprite.rect)
+        if dokill:
+            for hit in hit_list:
+                self.remove(hit)
+                hit.kill()
+        return hit_list
+
 def terminate():
     """ This function is called when the user closes the window or presses ESC """
+    for hook in list(EXIT_HOOKS):
+        hook()
     pygame.quit()
     os._exit(1)
 
 class Player(pygame.sprite.Sprite):
     """The player controlled by the user"""
-    def __init__(self, image, lives, points):
+    def __init__(self, lives, points):
         pygame.sprite.Sprite.__init__(self)
 
         # setting up the players image, lives and points
-        self.original = image
-        self.image = pygame.transform.scale(image,(90,80))
+        self.original = ASSETS.image('pink_kirby.png')
+        self.images = (ASSETS.frame('pink_kirby.png', PLAYERSIZE),
+                       ASSETS.frame('pink_kirby.png', PLAYERSIZE, True))
+        self.image = self.images[0]
+        self.flipped = False
         self.rect = self.image.get_rect()
         self.lives = lives
         self.points = points
@@ -107,178 +428,1216 @@ class Player(pygame.sprite.Sprite):
         # set up speed vector of the player
         self.x_change = 0
         self.y_change = 0
+        self.x_fraction = 0
+        self.y_fraction = 0
+
+        # which sides of the player rest against a platform
+        self.grounded = self.ceiling = False
+        self.wall_left = self.wall_right = False
+
+        # where the player was before the last physics step
+        self.previous = None
                
-    def update(self, platforms):
+    def update(self, platforms, dt=1.0):
         """This function allows the player to run, jump and duck"""
-        gravity(self, platforms)
+        gravity(self, dt)
+        reach, blocks = platforms_near(self, platforms, self.x_change * dt, self.y_change * dt)
 
         # moving the player left and right
-        self.rect.left += self.x_change
+        move_x(self, self.x_change * dt)
 
         # see if we hit anything in the horizontal plane
-        horizontal_collision(self, platforms)
+        horizontal_collision(self, blocks)
 
         # Move up/down
-        self.rect.y += self.y_change
+        move_y(self, self.y_change * dt)
 
         # see if we hit anything in the vertical plane
-        vertical_collisions(self, platforms)
+        vertical_collisions(self, blocks)
+
+        # see what the player ended up resting against
+        sense_after_move(self, platforms, reach, blocks)
             
-    def jump(self, platforms):
-        """This function allows the player to jump"""
-        # move down a bit and see if there is a platform beneath us
-        # move down 2 pixels, bc 1 doesn't work well
-        self.rect.y += 2
-        platform_hit_list = pygame.sprite.spritecollide(self, platforms, False)
-        self.rect.y -= 2
-        # if it is okay to jump, set our speed upwards
-        if len(platforms) > 0 or self.rect.bottom >= GROUND:
-            self.y_change = -13
+    def jump(self):
+        """This function makes the player jump if they are standing on a platform,
+            and returns whether they did"""
+        if not self.grounded:
+            return False
+        # set our speed upwards. The player is off the ground until the next
+        # step says otherwise, so a second press can't jump again
+        self.y_change = JUMPSPEED
+        self.grounded = False
+        return True
 
     def flip_head(self):
         """This function flips the players head depending on what direction the player moves"""
-        self.image = pygame.transform.flip(self.image, True, False)
+        self.flipped = not self.flipped
+        # both ways are already in the atlas, so this only swaps which one is drawn
+        self.image = self.images[self.flipped]
             
-class Background(pygame.sprite.Sprite):
-    """The background for the game"""
-    def __init__(self, background_image):
-        pygame.sprite.Sprite.__init__(self)
-
+class Camera():
+    """The camera decides which part of the world is shown in the window.
+        Everything in the game keeps its world position and is only moved
+        by the camera offset when it is drawn"""
+    def __init__(self, world_width, one_way=False):
+        # the left edge of the window in world coordinates. A world_width of None
+        # means the world has no right end
+        self.x = 0
+        self.world_width = world_width
+
+        # a one way camera never scrolls back left
+        self.one_way = one_way
+
+        # where the camera was before the last physics step, and where it is
+        # drawn from, which can be in between the two
+        self.previous_x = 0
+        self.view_x = 0
+        self.alpha = 1.0
+
+    def follow(self, target):
+        """This function scrolls the camera so the target stays inside the window"""
+        start_x = self.x
+
+        # scroll right if the target moves past the middle of the screen
+        if target.rect.right - self.x > WINDOWWIDTH/2:
+            self.x = target.rect.right - WINDOWWIDTH/2
+        # scroll left if the target gets close to the left side of the screen
+        elif target.rect.left - self.x < WINDOWWIDTH/4:
+            self.x = target.rect.left - WINDOWWIDTH/4
+
+        # never scroll past either end of the world, or back if one way
+        if self.world_width is not None:
+            self.x = min(self.x, self.world_width - WINDOWWIDTH)
+        if self.one_way:
+            self.x = max(self.x, start_x)
+        self.x = int(max(0, self.x))
+        self.view_x = self.x
+
+    def interpolate(self, alpha):
+        """This function sets how far between the last two physics steps the next
+            frame is drawn, from 0 (the step before) to 1 (the latest step)"""
+        self.alpha = alpha
+        self.view_x = round(self.previous_x + (self.x - self.previous_x) * alpha)
+
+    def apply(self, rect):
+        """This function returns the screen position of a world rect"""
+        return rect.move(-self.view_x, 0)
+
+    def screen_rect(self, sprite):
+        """This function returns where a sprite is drawn on the screen, in between
+            its last two positions if it moves"""
+        rect = sprite.rect
+        previous = getattr(sprite, 'previous', None)
+        if previous is not None and self.alpha < 1:
+            rect = rect.move(round((previous[0] - rect.x) * (1 - self.alpha)),
+                             round((previous[1] - rect.y) * (1 - self.alpha)))
+        return self.apply(rect)
+
+    def is_visible(self, rect):
+        """This function checks if a world rect is inside the window"""
+        return rect.right > self.view_x and rect.left < self.view_x + WINDOWWIDTH
+
+    def draw(self, group, surface):
+        """This function draws the visible sprites of a group at their screen position"""
+        surface.blits([(sprite.image, self.screen_rect(sprite))
+                       for sprite in group if self.is_visible(sprite.rect)], doreturn=False)
+
+class Background():
+    """The background for the game. The background image is stretched across the
+        world, but it is cut into TILEWIDTH wide tiles that are only scaled when they
+        come into view. The least recently used tiles are thrown away, so memory
+        stays the same however long the world is"""
+    def __init__(self, background_image, width=MAXBG):
         # setting up the background image
         self.original = background_image
-        self.image = pygame.transform.scale(background_image, (MAXBG, WINDOWHEIGHT))
-        self.rect = self.image.get_rect()
-        
-        # set up speed vector of the background
-        self.x_change = 0
-
-    def update(self):
-        # moving the background left and right
-        self.rect.left += self.x_change
+        self.width = width
+
+        # the scaled tiles, oldest first
+        self.tiles = OrderedDict()
+
+    def tile(self, index):
+        """This function returns a background tile, scaling it if it isn't cached"""
+        if index in self.tiles:
+            self.tiles.move_to_end(index)
+            return self.tiles[index]
+
+        # find the part of the original image that this tile stretches over
+        left = index * TILEWIDTH
+        tile_width = min(TILEWIDTH, self.width - left)
+        scale = self.original.get_width() / self.width
+        source_left = int(left * scale)
+        source_right = max(source_left + 1, min(self.original.get_width(),
+                                                math.ceil((left + tile_width) * scale)))
+        source = self.original.subsurface((source_left, 0, source_right - source_left,
+                                           self.original.get_height()))
+
+        # the background has no transparency, so convert() makes blitting it cheaper
+        tile = pygame.transform.scale(source, (tile_width, WINDOWHEIGHT)).convert()
+        self.tiles[index] = tile
+        if len(self.tiles) > TILECACHE:
+            self.tiles.popitem(last=False)
+        return tile
+
+    def draw(self, surface, camera, area=None):
+        """This function draws the part of the background under a screen area,
+            or the whole window if no area is given"""
+        if area is None:
+            area = surface.get_rect()
+
+        # walk across the area one tile at a time. The background repeats past the
+        # end of the world, which endless levels rely on
+        camera_x = camera.view_x
+        x = area.left + camera_x
+        while x < area.right + camera_x:
+            index = (x % self.width) // TILEWIDTH
+            tile = self.tile(index)
+            tile_left = x - (x % self.width - index * TILEWIDTH)
+            source = area.move(camera_x - tile_left, 0).clip(tile.get_rect())
+            surface.blit(tile, (tile_left - camera_x + source.x, source.y), source)
+            x = tile_left + tile.get_width()
 
 class Coin(pygame.sprite.Sprite):
     """The coins for the player to collect"""
-    def __init__(self, coin_image):
+    # the size of a coin
+    SIZE = (50, 50)
+
+    def __init__(self, x):
         pygame.sprite.Sprite.__init__(self)
         
-        self.original = coin_image
-        self.image = pygame.transform.scale(coin_image,(50,50))
+        self.original = ASSETS.image('coin.png')
+        self.image = ASSETS.frame('coin.png', Coin.SIZE)
         self.rect = self.image.get_rect()
 
-        # set the position to a random location
+        # set the position on the ground
         self.rect.top = GROUND - self.rect.height
-        self.rect.left = random.randrange(0, 6500 - self.rect.width)
+        self.rect.left = x
 
-        # set up speed vector of the coins
-        self.x_change = 0
-        self.y_change = 0
 
-    def update(self):
-        """This function allows the pipes and platforms to move along with the background"""
-        # moving the coins left and right
-        self.rect.left += self.x_change
-
-class Obstacles(pygame.sprite.Sprite):
+class StaticRect():
     """The platforms for the player to jump onto
         and the plants for player to collide with
-        and the wall the player collides with to win the game"""
-    def __init__(self, width, height, transparent_image):
-        pygame.sprite.Sprite.__init__(self)
-        
-        self.original = transparent_image
-        self.image = pygame.transform.scale(transparent_image,([width, height]))
-        self.rect = self.image.get_rect()
-
-        # set up speed vector of the barriers
-        self.x_change = 0
-
-    def update(self):
-        """This function allows the pipes and platforms to move along with the background"""
-        # moving the barriers left and right
-        self.rect.left += self.x_change
+        and the wall the player collides with to win the game.
+        They are drawn as part of the background, so they are only a rect and the
+        level key they came from, with no image"""
+    __slots__ = ('rect', 'key')
+
+    def __init__(self, width, height, x, y, key=None):
+        self.rect = pygame.Rect(x, y, width, height)
+        self.key = key
+
+class Level():
+    """The layout of a level: its platforms, poisonous plants, winning block and
+        coins. Levels are JSON files split into chunks of chunk_width pixels, and
+        every obstacle is listed in the chunk its left edge is in as
+        [width, height, x, y]. The coins are scattered with the game's random
+        numbers when the level is loaded"""
+    # the kinds of obstacles a chunk can hold
+    KINDS = ('platforms', 'plants', 'win')
+
+    # fixed levels have a right end
+    endless = False
+
+    def __init__(self, data, rng):
+        self.width = data['width']
+        self.chunk_width = data['chunk_width']
+
+        # every item in the level as (kind, width, height, x, y)
+        self.items = []
+        for chunk in data['chunks']:
+            for kind in Level.KINDS:
+                for width, height, x, y in chunk.get(kind, []):
+                    self.items.append((kind, width, height, x, y))
+        coin_width, coin_height = Coin.SIZE
+        for i in range(data['coins']['count']):
+            x = rng.randrange(0, data['coins']['right'] - coin_width)
+            self.items.append(('coins', coin_width, coin_height, x, GROUND - coin_height))
+
+        # maps a chunk number to the items that overlap it, so wide obstacles
+        # are loaded while any part of them is near the camera
+        self.chunks = {}
+        for number, (kind, width, height, x, y) in enumerate(self.items):
+            for chunk in range(x // self.chunk_width, (x + width - 1) // self.chunk_width + 1):
+                self.chunks.setdefault(chunk, []).append(number)
+
+    @staticmethod
+    def load(filename, rng):
+        """This function reads a level from a JSON file"""
+        with open(filename) as level_file:
+            return Level(json.load(level_file), rng)
+
+    def chunks_near(self, camera_x):
+        """This function returns the chunk numbers within CHUNKMARGIN of the window"""
+        first = max(0, (camera_x - CHUNKMARGIN) // self.chunk_width)
+        last = min((self.width - 1) // self.chunk_width,
+                   (camera_x + WINDOWWIDTH + CHUNKMARGIN) // self.chunk_width)
+        return range(int(first), int(last) + 1)
+
+    def chunk_items(self, chunk):
+        """This function returns (key, item) for every item in a chunk"""
+        return [(number, self.items[number]) for number in self.chunks.get(chunk, ())]
+
+    def prepare(self, camera_x):
+        """Fixed levels are loaded all at once, so there is nothing to prepare"""
+
+    def forget(self, chunk):
+        """Fixed levels keep all their chunks"""
+
+class EndlessLevel():
+    """A level with no end for the endless runner mode. Chunks are generated from
+        the seed as the camera gets near them and forgotten once it has passed,
+        so the level costs the same however far the player runs. Every chunk
+        starts and ends on solid ground, gaps are never wider than MAXGAP and
+        steps never higher than MAXSTEP, so every chunk can be crossed with the
+        player's jump"""
+    endless = True
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.width = None
+        self.chunk_width = ENDLESSCHUNK
+
+        # the generated chunks, oldest first
+        self.generated = OrderedDict()
+
+    def chunks_near(self, camera_x):
+        """This function returns the chunk numbers within CHUNKMARGIN of the window"""
+        first = max(0, (camera_x - CHUNKMARGIN) // self.chunk_width)
+        last = (camera_x + WINDOWWIDTH + CHUNKMARGIN) // self.chunk_width
+        return range(int(first), int(last) + 1)
+
+    def chunk_items(self, chunk):
+        """This function returns (key, item) for every item in a chunk"""
+        if chunk not in self.generated:
+            self.generated[chunk] = self.generate(chunk)
+            if len(self.generated) > ENDLESSCACHE:
+                self.generated.popitem(last=False)
+        return self.generated[chunk]
+
+    def prepare(self, camera_x):
+        """This function generates the next chunk ahead of the camera that isn't
+            ready yet. Only one chunk is made per call, so the work is spread out
+            over frames instead of landing all at once"""
+        last = self.chunks_near(camera_x)[-1]
+        for chunk in range(last + 1, last + 1 + ENDLESSLOOKAHEAD):
+            if chunk not in self.generated:
+                self.chunk_items(chunk)
+                return
+
+    def forget(self, chunk):
+        """This function throws away a chunk the camera has passed"""
+        self.generated.pop(chunk, None)
+
+    def generate(self, chunk):
+        """This function makes the platforms, gaps, plants, coins and creatures of a
+            chunk. The same seed and chunk always make the same layout"""
+        rng = random.Random(self.seed * 1000003 + chunk)
+        left = chunk * self.chunk_width
+        right = left + self.chunk_width
+        items = []
+
+        def add(kind, width, height, x, y):
+            items.append(((chunk, len(items)), (kind, width, height, x, y)))
+
+        x = left
+        while x < right:
+            length = rng.randrange(250, 600)
+            gap = rng.randrange(80, MAXGAP)
+            # finish the chunk with ground if another gap and piece don't fit
+            if x + length + gap + 250 > right:
+                length = right - x
+                gap = 0
+            add('platforms', length, 100, x, GROUND)
+
+            # coins along the ground
+            for i in range(rng.randrange(0, 3)):
+                add('coins', Coin.SIZE[0], Coin.SIZE[1],
+                    x + rng.randrange(0, length - Coin.SIZE[0]), GROUND - Coin.SIZE[1])
+
+            # one hazard per long enough piece of ground, away from its edges, and
+            # none where the player starts
+            if x >= WINDOWWIDTH / 2 and length >= 300:
+                hazard = rng.random()
+                if hazard < 0.35:
+                    width = rng.randrange(60, 120)
+                    height = rng.randrange(50, MAXSTEP)
+                    add('platforms', width, height,
+                        x + rng.randrange(100, length - width - 50), GROUND - height)
+                elif hazard < 0.55:
+                    add('plants', 45, 120, x + rng.randrange(100, length - 145), GROUND - 120)
+                elif hazard < 0.7:
+                    # high enough for the player to run underneath
+                    width = rng.randrange(120, min(250, length))
+                    add('platforms', width, 60, x + rng.randrange(0, length - width + 1),
+                        GROUND - 150 - rng.randrange(0, 60))
+                if rng.random() < 0.3:
+                    add('creatures', 50, 50, x + length // 2, 0)
+
+            x += length + gap
+        return items
+
+def flight(y_change):
+    """This function returns how far below its starting point an object is after
+        each frame of a jump or fall that starts at y_change, and how fast it is
+        falling then, the way gravity moves it, until it is far below the screen"""
+    path = []
+    y = 0.0
+    while y < WINDOWHEIGHT:
+        y_change = 1 if y_change == 0 else y_change + GRAVITY
+        y += y_change
+        path.append((y, y_change))
+    return path
+
+class NavGraph():
+    """Which parts of a level's platforms the player can get between, worked out
+        from the level's geometry and the player's speed, jump and gravity instead
+        of by playing. A node is a stretch of a platform's top the player can stand
+        on: a platform with the plants and other platforms in the player's way cut
+        out of it. There is an edge from one node to another if a jump or a fall
+        from anywhere on the first lands anywhere on the second. Jumps aren't
+        checked against what they might bump into on the way, so the graph is
+        hopeful about tight spots. Whether one node can reach another, directly or
+        not, is worked out when the graph is made, so bots can look it up at once"""
+    def __init__(self, nodes, edges, goals, start):
+        # each node as (top, lowest x, highest x) of the player's left side
+        self.nodes = [tuple(node) for node in nodes]
+        self.edges = [set(targets) for targets in edges]
+        self.goals = set(goals)
+        self.start = start
+
+        # every node each node can get to in any number of jumps
+        self.reachable = []
+        for node in range(len(self.nodes)):
+            seen = set([node])
+            stack = [node]
+            while stack:
+                for target in self.edges[stack.pop()]:
+                    if target not in seen:
+                        seen.add(target)
+                        stack.append(target)
+            self.reachable.append(seen)
+
+    @staticmethod
+    def build(items, width=None, goal_x=None):
+        """This function makes the graph of a level from its items, as (kind, width,
+            height, x, y). The goal is the winning block, or if there isn't one,
+            standing at goal_x or further right"""
+        player_width, player_height = PLAYERSIZE
+        platforms = [pygame.Rect(x, y, w, h) for kind, w, h, x, y in items if kind == 'platforms']
+        plants = [pygame.Rect(x, y, w, h) for kind, w, h, x, y in items if kind == 'plants']
+        wins = [pygame.Rect(x, y, w, h) for kind, w, h, x, y in items if kind == 'win']
+
+        # the stretches of each platform the player can stand on
+        nodes = []
+        for platform in platforms:
+            top = platform.top
+            body = pygame.Rect(0, top - player_height, 0, player_height)
+            spans = [(platform.left - player_width + 1, platform.right - 1)]
+            if width is not None:
+                spans = [(max(0, low), min(width - player_width, high)) for low, high in spans]
+            for other in platforms + plants:
+                if other is platform or other.bottom <= body.top or other.top >= body.bottom:
+                    continue
+                cut_low, cut_high = other.left - player_width + 1, other.right - 1
+                pieces = []
+                for low, high in spans:
+                    if cut_low > low:
+                        pieces.append((low, min(high, cut_low - 1)))
+                    if cut_high < high:
+                        pieces.append((max(low, cut_high + 1), high))
+                spans = [(low, high) for low, high in pieces if low <= high]
+            for low, high in spans:
+                nodes.append((top, low, high))
+
+        # an edge wherever a jump or a fall lands within running distance
+        paths = [flight(JUMPSPEED), flight(0)]
+        edges = []
+        for top, low, high in nodes:
+            targets = set()
+            for target, (other_top, other_low, other_high) in enumerate(nodes):
+                drop = other_top - top
+                for path in paths:
+                    before = 0.0
+                    for frame, (y, y_change) in enumerate(path, 1):
+                        if y_change > 0 and before <= drop <= y:
+                            reach = RUNSPEED * frame
+                            if low - reach <= other_high and high + reach >= other_low:
+                                targets.add(target)
+                            break
+                        before = y
+            edges.append(targets)
+
+        # the nodes the goal can be reached from
+        jump = flight(JUMPSPEED)
+        rise = -min(y for y, y_change in jump)
+        reach = RUNSPEED * len([y for y, y_change in jump if y <= 0])
+        goals = set()
+        for node, (top, low, high) in enumerate(nodes):
+            if goal_x is not None and high >= goal_x - player_width:
+                goals.add(node)
+            for win in wins:
+                if (low - reach < win.right and high + reach + player_width > win.left and
+                        top - player_height - rise < win.bottom and top > win.top):
+                    goals.add(node)
+
+        # the player starts on the ground at the left of the level
+        start = None
+        for node, (top, low, high) in enumerate(nodes):
+            if top == GROUND and low <= 100 <= high:
+                start = node
+        return NavGraph(nodes, edges, goals, start)
+
+    @staticmethod
+    def for_level(level):
+        """This function makes the graph of a fixed level"""
+        return NavGraph.build([item for item in level.items if item[0] != 'coins'], level.width)
+
+    @staticmethod
+    def for_endless(level, chunks=NAVCHUNKS):
+        """This function makes the graph of the first chunks of an endless level,
+            with running off the right of the last chunk as the goal"""
+        items = []
+        for chunk in range(chunks):
+            items += [item for key, item in level.generate(chunk) if item[0] not in ('coins', 'creatures')]
+        return NavGraph.build(items, goal_x=chunks * level.chunk_width - PLAYERSIZE[0])
+
+    def node_at(self, x, bottom):
+        """This function returns the node the player is standing in with their left
+            side at x and their bottom at bottom, or None"""
+        for node, (top, low, high) in enumerate(self.nodes):
+            if top == bottom and low <= x <= high:
+                return node
+        return None
+
+    def can_reach(self, node, target):
+        """This function returns whether the player can get from one node to another"""
+        return target in self.reachable[node]
+
+    def can_win(self, node):
+        """This function returns whether the player can get to the goal from a node"""
+        return not self.goals.isdisjoint(self.reachable[node])
+
+    def solvable(self):
+        """This function returns whether the level can be finished from the start"""
+        return self.start is not None and self.can_win(self.start)
+
+    def save(self, filename):
+        """This function writes the graph to a JSON file"""
+        with open(filename, 'w') as nav_file:
+            json.dump({'nodes': self.nodes, 'edges': [sorted(targets) for targets in self.edges],
+                       'goals': sorted(self.goals), 'start': self.start}, nav_file)
+
+    @staticmethod
+    def load(filename):
+        """This function reads a graph from a JSON file"""
+        with open(filename) as nav_file:
+            data = json.load(nav_file)
+        return NavGraph(data['nodes'], data['edges'], data['goals'], data['start'])
+
+def nav_file(level_file):
+    """This function returns the name the navigation graph of a level is saved as"""
+    return os.path.splitext(level_file)[0] + NAVEXTENSION
+
+class LevelStream():
+    """Creates the sprites of a level's chunks when the camera gets near them and
+        lets go of them once the camera has moved away, so only the part of the
+        level around the window is ever in memory"""
+    def __init__(self, level, game):
+        self.level = level
+
+        # the group and collision grid each kind of item goes in. The level's
+        # geometry isn't drawn, so it only goes in a grid
+        self.places = {'platforms': (None, game.platform_index),
+                       'plants': (None, game.plant_index),
+                       'win': (None, game.win_index),
+                       'coins': (game.coin_list, game.coin_index)}
+        self.all_sprites = game.all_sprites
+        self.game = game
+        self.coin_batch = game.coin_batch
+
+        # the keys of coins picked up and creatures already let loose, which
+        # never come back
+        self.used = set()
+
+        # the chunks that are loaded and the sprites made for them
+        self.loaded = set()
+        self.sprites = {}
+
+    def add(self, kind, sprite):
+        """This function puts a sprite in its group and collision grid"""
+        group, index = self.places[kind]
+        if group is not None:
+            group.add(sprite)
+            self.all_sprites.add(sprite)
+        index.insert(sprite)
+
+    def remove(self, kind, sprite):
+        """This function takes a sprite out of its group and collision grid"""
+        group, index = self.places[kind]
+        index.remove(sprite)
+        if group is not None:
+            sprite.kill()
+
+    def update(self, camera_x):
+        """This function loads the chunks near the camera and unloads the rest"""
+        self.level.prepare(camera_x)
+        wanted = set(self.level.chunks_near(camera_x))
+        if wanted == self.loaded:
+            return
+
+        # chunks left behind in an endless level are never seen again
+        if self.level.endless:
+            first = min(wanted)
+            for chunk in self.loaded - wanted:
+                if chunk < first:
+                    self.level.forget(chunk)
+            self.used = set(key for key in self.used if key[0] >= first)
+        self.loaded = wanted
+
+        # the items the loaded chunks need
+        items = {}
+        for chunk in sorted(wanted):
+            for key, item in self.level.chunk_items(chunk):
+                items[key] = item
+
+        for key in list(self.sprites):
+            if key not in items:
+                kind, sprite = self.sprites.pop(key)
+                if kind == 'coins' and self.coin_batch is not None:
+                    self.coin_batch.kill([sprite])
+                else:
+                    self.remove(kind, sprite)
+
+        for key, (kind, width, height, x, y) in items.items():
+            if key in self.sprites or key in self.used:
+                continue
+            if kind == 'creatures':
+                # creatures wander off, so they are only let loose once
+                self.game.spawn_creature(x)
+                self.used.add(key)
+                continue
+            if kind == 'coins' and self.coin_batch is not None:
+                self.sprites[key] = (kind, self.coin_batch.spawn(x, y, key))
+                continue
+            if kind == 'coins':
+                sprite = Coin(x)
+                sprite.key = key
+            else:
+                sprite = StaticRect(width, height, x, y, key)
+            self.sprites[key] = (kind, sprite)
+            self.add(kind, sprite)
+
+    def reload(self, used, camera_x):
+        """This function lets go of every sprite and loads the level around the
+            camera again, with used as the coins and creatures already taken"""
+        for key, (kind, sprite) in self.sprites.items():
+            if kind == 'coins' and self.coin_batch is not None:
+                self.coin_batch.kill([sprite])
+            else:
+                self.remove(kind, sprite)
+        self.sprites = {}
+        self.loaded = set()
+        self.used = set(used)
+        self.update(camera_x)
+
+    def collect(self, key):
+        """This function remembers that a coin was picked up, so it never comes back"""
+        self.used.add(key)
+        self.sprites.pop(key, None)
 
 class Creature(pygame.sprite.Sprite):
     """This class is for the evil creatures that can kill the player"""
-    def __init__(self, image):
+    def __init__(self):
         pygame.sprite.Sprite.__init__(self)
 
-        self.original = image
-        self.image = pygame.transform.scale(image, (50,50))
+        self.original = ASSETS.image('creature.png')
+        self.image = ASSETS.frame('creature.png', (50,50))
         self.rect = self.image.get_rect()
 
-        # set the position to a location
-        self.rect.y = random.randrange(0, GROUND - self.rect.height)
-        self.rect.x = WINDOWWIDTH
-
         self.y_change = 0
+        self.x_fraction = 0
+        self.y_fraction = 0
+        self.grounded = self.ceiling = False
+        self.wall_left = self.wall_right = False
+        self.previous = None
+
+    def reset(self, x, rng):
+        """This function places the creature at a new location in the world"""
+        self.rect.y = rng.randrange(0, GROUND - self.rect.height)
+        self.rect.x = x
+        self.y_change = 0
+        self.x_fraction = 0
+        self.y_fraction = 0
+        self.grounded = self.ceiling = False
+        self.wall_left = self.wall_right = False
+        self.previous = None
 
-    def update(self, platforms):
+    def update(self, platforms, dt=1.0):
         """This function allows the player to run, jump and duck"""
-        gravity(self, platforms)
+        gravity(self, dt)
+        reach, blocks = platforms_near(self, platforms, -3 * dt, self.y_change * dt)
 
         # moving the creature left and right
-        self.rect.x -= 3
+        move_x(self, -3 * dt)
 
         # See if we hit anything in the horizontal plane
-        block_hit_list = pygame.sprite.spritecollide(self, platforms, False)
+        block_hit_list = touching(self, blocks)
         for block in block_hit_list:
             # left side of creature is right side of block
             self.rect.left = block.rect.right
 
         # Move down
-        self.rect.y += self.y_change
+        move_y(self, self.y_change * dt)
 
         # see if we hit anything in the vertical plane
-        vertical_collisions(self, platforms)
+        vertical_collisions(self, blocks)
+
+        # see what the creature ended up resting against
+        sense_after_move(self, platforms, reach, blocks)
 
 class Star(pygame.sprite.Sprite):
-    """This class is for the evil creatures that can kill the player"""
-    def __init__(self, image):
+    """This class is for the shooting stars that give the player a life"""
+    def __init__(self):
         pygame.sprite.Sprite.__init__(self)
 
-        self.original = image
-        self.image = pygame.transform.scale(image, (60,50))
+        self.original = ASSETS.image('star.png')
+        self.image = ASSETS.frame('star.png', (60,50))
         self.rect = self.image.get_rect()
+        self.x_fraction = 0
+        self.previous = None
 
-        # set the position to a location
-        self.rect.y = random.randrange(0, 200)
-        self.rect.x = WINDOWWIDTH
+    def reset(self, x, rng):
+        """This function places the star at a new location in the world"""
+        self.rect.y = rng.randrange(0, 200)
+        self.rect.x = x
+        self.x_fraction = 0
+        self.previous = None
 
-    def update(self):
+    def update(self, dt=1.0):
         """This function allows the player to run, jump and duck"""
 
         # moving the star left
-        self.rect.left -= 8
-        
+        move_x(self, -8 * dt)
+
+class EntityBatch():
+    """Keeps many entities of one kind in numpy arrays, one array per field, and
+        moves, collides and draws them all at once. Thousands of creatures, coins
+        or stars then cost a few array operations a step instead of a Python call
+        per sprite. Entities move left at speed pixels a frame, and ones that fall
+        land on and bump into platforms the same way Creature does"""
+    def __init__(self, filename, size, capacity, speed=0, falls=False):
+        self.image = ASSETS.frame(filename, size)
+        self.width, self.height = size
+        self.speed = speed
+        self.falls = falls
+
+        # the fields of every entity. Slots that aren't alive are free
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.y_change = np.zeros(capacity)
+        self.previous_x = np.zeros(capacity)
+        self.previous_y = np.zeros(capacity)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.keys = [None] * capacity
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        return int(np.count_nonzero(self.alive))
+
+    def spawn(self, x, y, key=None):
+        """This function places an entity in a free slot and returns the slot, or
+            returns None if every slot is in use"""
+        if not self.free:
+            return None
+        slot = self.free.pop()
+        self.x[slot] = self.previous_x[slot] = x
+        self.y[slot] = self.previous_y[slot] = y
+        self.y_change[slot] = 0
+        self.alive[slot] = True
+        self.keys[slot] = key
+        return slot
+
+    def kill(self, slots):
+        """This function frees the slots of entities that are gone"""
+        for slot in slots:
+            if self.alive[slot]:
+                self.alive[slot] = False
+                self.keys[slot] = None
+                self.free.append(int(slot))
+
+    def overlaps(self, x, y, platforms):
+        """This function returns a (entities, platforms) array that is True where an
+            entity at x, y overlaps a platform"""
+        return ((x[:, None] < platforms[:, 2]) & (x[:, None] + self.width > platforms[:, 0]) &
+                (y[:, None] < platforms[:, 3]) & (y[:, None] + self.height > platforms[:, 1]))
+
+    def step(self, platforms, dt=1.0):
+        """This function moves every entity by one physics step. platforms is an
+            array of [left, top, right, bottom] rows"""
+        live = np.flatnonzero(self.alive)
+        if len(live) == 0 or (self.speed == 0 and not self.falls):
+            return
+        x = self.x[live]
+        y = self.y[live]
+        y_change = self.y_change[live]
+        self.previous_x[live] = x
+        self.previous_y[live] = y
+        tops = platforms[:, 1]
+
+        if self.falls:
+            # gravity, and standing on whatever is underneath
+            y_change = np.where(y_change == 0, 1.0, y_change + GRAVITY * dt)
+            standing = (self.overlaps(x, y, platforms) & (y[:, None] >= tops - self.height) &
+                        (y_change[:, None] >= 0))
+            landed = standing.any(axis=1)
+            y = np.where(landed, np.where(standing, tops, np.inf).min(axis=1) - self.height, y)
+            y_change = np.where(landed, 0.0, y_change)
+
+        # move left, and get pushed back out of any platform walked into
+        x = x - self.speed * dt
+        if self.falls:
+            hit = self.overlaps(x, y, platforms)
+            x = np.where(hit.any(axis=1), np.where(hit, platforms[:, 2], -np.inf).max(axis=1), x)
+
+            # move down and stop on top of, or under, any platform hit
+            y = y + y_change * dt
+            hit = self.overlaps(x, y, platforms)
+            hit_any = hit.any(axis=1)
+            falling = hit_any & (y_change > 0)
+            rising = hit_any & (y_change < 0)
+            y = np.where(falling, np.where(hit, tops, np.inf).min(axis=1) - self.height, y)
+            y = np.where(rising, np.where(hit, platforms[:, 3], -np.inf).max(axis=1), y)
+            y_change = np.where(hit_any, 0.0, y_change)
+
+        self.x[live] = x
+        self.y[live] = y
+        self.y_change[live] = y_change
+
+    def snapshot(self):
+        """This function returns the live entities as a list of (x, y, y_change, key)"""
+        live = np.flatnonzero(self.alive)
+        return list(zip(self.x[live].tolist(), self.y[live].tolist(),
+                        self.y_change[live].tolist(), [self.keys[slot] for slot in live]))
+
+    def restore(self, entities):
+        """This function replaces the live entities with ones from snapshot"""
+        self.kill(np.flatnonzero(self.alive))
+        for x, y, y_change, key in entities:
+            slot = self.spawn(x, y, key)
+            self.y_change[slot] = y_change
+
+    def collide(self, rect):
+        """This function kills the entities that overlap a world rect and returns
+            their keys"""
+        hit = np.flatnonzero(self.alive & (self.x < rect.right) & (self.x + self.width > rect.left) &
+                             (self.y < rect.bottom) & (self.y + self.height > rect.top))
+        keys = [self.keys[slot] for slot in hit]
+        self.kill(hit)
+        return keys
+
+    def cull(self, left):
+        """This function kills the entities left of the world position left or that
+            have fallen out of the world"""
+        gone = self.alive & ((self.x + self.width < left) | (self.y > WINDOWHEIGHT))
+        self.kill(np.flatnonzero(gone))
+
+    def draw(self, surface, camera):
+        """This function draws every visible entity, in between its last two
+            positions like Camera.screen_rect does for sprites"""
+        live = np.flatnonzero(self.alive)
+        alpha = camera.alpha
+        x = self.previous_x[live] + (self.x[live] - self.previous_x[live]) * alpha - camera.view_x
+        y = self.previous_y[live] + (self.y[live] - self.previous_y[live]) * alpha
+        visible = (x + self.width > 0) & (x < WINDOWWIDTH)
+        image = self.image
+        surface.blits([(image, (int(left), int(top)))
+                       for left, top in zip(x[visible].tolist(), y[visible].tolist())],
+                      doreturn=False)
+
+class SpritePool():
+    """Keeps a fixed number of sprites that are reused instead of created and thrown
+        away. Sprites that leave the world are put back in the pool, so the number
+        of live sprites never grows past the size of the pool"""
+    def __init__(self, sprite_class, size, group, all_sprites, index):
+        # the sprites waiting to be used
+        self.free = [sprite_class() for i in range(size)]
+
+        # where live sprites are kept
+        self.group = group
+        self.all_sprites = all_sprites
+        self.index = index
+
+    def spawn(self, x, rng):
+        """This function places a sprite from the pool in the world and returns it,
+            or returns None if every sprite is already in use"""
+        if not self.free:
+            return None
+        sprite = self.free.pop()
+        sprite.reset(x, rng)
+        self.group.add(sprite)
+        self.all_sprites.add(sprite)
+        self.index.insert(sprite)
+        return sprite
+
+    def release(self, sprite):
+        """This function takes a sprite out of the world and puts it back in the pool"""
+        self.index.remove(sprite)
+        sprite.kill()
+        self.free.append(sprite)
+
+    def cull(self, left):
+        """This function releases the sprites that are left of the world position
+            left or have fallen out of the world"""
+        for sprite in self.group.sprites():
+            if sprite.rect.right < left or sprite.rect.top > WINDOWHEIGHT:
+                self.release(sprite)
+
+class DirtyRenderer():
+    """Redraws only the parts of the window that changed since the last frame.
+        While the camera is still, the background is restored under the old and
+        new position of every sprite that moved, changed its image, appeared or
+        disappeared, and only
+        those rects are passed to pygame.display.update. When the camera moves the
+        whole window is redrawn, because every pixel changes anyway"""
+    def __init__(self):
+        # the camera position, sprite positions and images and HUD of the last
+        # frame drawn
+        self.camera_x = None
+        self.sprite_rects = {}
+        self.hud_values = None
+        self.hud_rects = []
+
+    def render(self, game, windowSurface):
+        """This function draws a frame and updates the changed parts of the screen"""
+        camera = game.camera
+        sprite_rects = {}
+        for sprite in game.all_sprites:
+            if camera.is_visible(sprite.rect):
+                sprite_rects[sprite] = (camera.screen_rect(sprite), sprite.image)
+        hud_values = (game.player.lives, game.player.points)
+
+        # redraw everything on the first frame, after the camera moves, on the
+        # ending and game over screens and when batched entities or debug overlays
+        # are drawn, as they aren't sprites this renderer can track
+        overlays = game.show_geometry or (game.profiler is not None and game.profiler.visible)
+        if (game.game_over or game.batches or game.transition is not None or overlays or
+                camera.view_x != self.camera_x):
+            self.hud_rects = game.draw(windowSurface)
+            pygame.display.update()
+            self.camera_x = None if game.game_over else camera.view_x
+            self.sprite_rects = sprite_rects
+            self.hud_values = hud_values
+            return
+
+        # collect the old and new rects of everything that moved or whose image
+        # changed, like the player turning around
+        dirty = []
+        for sprite, (rect, image) in sprite_rects.items():
+            old = self.sprite_rects.get(sprite)
+            if old is None:
+                dirty.append(rect)
+            elif old[0] != rect or old[1] is not image:
+                dirty += [rect, old[0]]
+        for sprite, (old_rect, old_image) in self.sprite_rects.items():
+            if sprite not in sprite_rects:
+                dirty.append(old_rect)
+        hud_rects = game.hud_rects()
+        if hud_values != self.hud_values:
+            dirty += self.hud_rects + hud_rects
+            self.hud_values = hud_values
+
+        # restore the background under each dirty rect and draw what overlaps it
+        screen = windowSurface.get_rect()
+        dirty = [rect.clip(screen) for rect in dirty if rect.colliderect(screen)]
+        for rect in dirty:
+            windowSurface.set_clip(rect)
+            game.background.draw(windowSurface, camera, rect)
+            for sprite, (sprite_rect, image) in sprite_rects.items():
+                if sprite_rect.colliderect(rect):
+                    windowSurface.blit(image, sprite_rect)
+            if rect.collidelist(hud_rects) != -1:
+                game.draw_hud(windowSurface)
+        windowSurface.set_clip(None)
+
+        self.hud_rects = hud_rects
+        self.sprite_rects = sprite_rects
+        pygame.display.update(dirty)
+
+class FrameProfiler():
+    """Times each part of every frame and keeps the last PROFILEFRAMES frames in a
+        ring buffer, along with the FPS and the number of sprites in each group.
+        The timings can be shown over the game and saved as CSV or JSON"""
+    def __init__(self, size=PROFILEFRAMES):
+        self.visible = False
+        self.frames = deque(maxlen=size)
+        self.current = dict.fromkeys(PROFILEPHASES, 0.0)
+        self.frame_start = time.perf_counter()
+        self.font = ASSETS.font("Courier New", 16)
+
+        # saves the frames when the game exits, if save_on_exit was called
+        self.save_hook = None
+
+    def time(self, phase, function, *args):
+        """This function calls function with args and adds the time it took to a
+            phase of the current frame"""
+        start = time.perf_counter()
+        result = function(*args)
+        self.current[phase] += time.perf_counter() - start
+        return result
+
+    def end_frame(self, game):
+        """This function saves the timings of the frame that just ended"""
+        now = time.perf_counter()
+        row = {'frame': game.frame, 'frame_ms': (now - self.frame_start) * 1000}
+        for phase in PROFILEPHASES:
+            row[phase + '_ms'] = self.current[phase] * 1000
+            self.current[phase] = 0.0
+        for name, group in PROFILEGROUPS:
+            row[name] = len(getattr(game, group))
+            if game.batch and name in PROFILEBATCHES:
+                row[name] += len(getattr(game, PROFILEBATCHES[name]))
+        self.frames.append(row)
+        self.frame_start = now
+
+    def attach(self, game):
+        """This function starts timing a game, leaving out the time spent in the
+            menus before it started"""
+        game.profiler = self
+        self.frame_start = time.perf_counter()
+        self.current = dict.fromkeys(PROFILEPHASES, 0.0)
+
+    def fps(self):
+        """This function returns the frames per second over the last few frames"""
+        recent = list(self.frames)[-PROFILEFPSFRAMES:]
+        total = sum(row['frame_ms'] for row in recent)
+        return len(recent) * 1000 / total if total else 0.0
+
+    def draw(self, surface):
+        """This function draws the last frame's timings in a box under the HUD"""
+        if not self.frames:
+            return
+        row = self.frames[-1]
+        lines = ['FPS %6.1f   frame %6.2f ms' % (self.fps(), row['frame_ms'])]
+        for phase in PROFILEPHASES:
+            lines.append('%-15s %6.2f ms' % (phase, row[phase + '_ms']))
+        lines.append('  '.join('%s %d' % (name, row[name]) for name, group in PROFILEGROUPS[:3]))
+        lines.append('  '.join('%s %d' % (name, row[name]) for name, group in PROFILEGROUPS[3:]))
+        height = self.font.get_linesize()
+        box = pygame.Surface((420, height * len(lines) + 10), SRCALPHA)
+        box.fill((0, 0, 0, 160))
+        for i, line in enumerate(lines):
+            box.blit(self.font.render(line, 1, (255, 255, 255)), (5, 5 + i * height))
+        surface.blit(box, (10, 60))
+
+    def save(self, filename):
+        """This function writes the remembered frames to a CSV file, or to a JSON
+            file if the name doesn't end in .csv"""
+        if self.save_hook in EXIT_HOOKS:
+            EXIT_HOOKS.remove(self.save_hook)
+        rows = list(self.frames)
+        with open(filename, 'w', newline='') as profile_file:
+            if filename.endswith('.csv'):
+                fields = (['frame', 'frame_ms'] + [phase + '_ms' for phase in PROFILEPHASES] +
+                          [name for name, group in PROFILEGROUPS])
+                writer = csv.DictWriter(profile_file, fields)
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                json.dump(rows, profile_file)
+
+    def save_on_exit(self, filename):
+        """This function saves the frames to filename when the game exits"""
+        self.save_hook = lambda: self.save(filename)
+        EXIT_HOOKS.append(self.save_hook)
+
+class Transition():
+    """The ending that plays once the game is won or lost. It is counted in physics
+        steps instead of seconds, so the game loop keeps running while it plays and
+        it takes just as many steps headless, where no time passes. The world
+        stands still while the ending screen fades in over it"""
+    def __init__(self, screen, seconds, sim_rate):
+        self.screen = screen
+        self.length = max(1, int(seconds * sim_rate))
+        self.step = 0
+
+    def update(self):
+        """This function moves the ending on by one physics step and returns True
+            once it is over"""
+        self.step += 1
+        return self.step >= self.length
+
+    def draw(self, surface, alpha=1.0):
+        """This function draws the ending screen over the world, as faded in as the
+            ending is far along. alpha says how far into the next step it is"""
+        progress = min(1.0, (self.step + alpha) / self.length)
+        self.screen.set_alpha(int(255 * progress))
+        surface.blit(self.screen, (0,0))
+        self.screen.set_alpha(None)
+
+class Hud():
+    """The lives and points shown at the top of the screen. The font, the labels
+        and every digit are rendered once into an atlas, and a value's picture is
+        only put together again from the atlas when the value changes"""
+    # the label and screen position of each value
+    LABELS = {'lives': ("Lives: ", (10, 0)),
+              'points': ("Points: ", (675, 0))}
+
+    def __init__(self):
+        self.font = ASSETS.font("Arial Black", 40)
+
+        # the rendered labels and characters
+        self.labels = {}
+        for name, (text, position) in Hud.LABELS.items():
+            self.labels[name] = self.font.render(text, 1, PINK)
+        self.glyphs = {}
+        for digit in '0123456789':
+            self.glyph(digit)
+
+        # maps a value name to its last value and picture
+        self.values = {}
+
+    def glyph(self, character):
+        """This function returns the picture of a character from the atlas"""
+        if character not in self.glyphs:
+            self.glyphs[character] = self.font.render(character, 1, PINK)
+        return self.glyphs[character]
+
+    def picture(self, name, value):
+        """This function returns the picture of a label and its value, putting it
+            together again only if the value changed"""
+        cached = self.values.get(name)
+        if cached is not None and cached[0] == value:
+            return cached[1]
+
+        pieces = [self.labels[name]] + [self.glyph(character) for character in str(value)]
+        width = sum(piece.get_width() for piece in pieces)
+        height = max(piece.get_height() for piece in pieces)
+        picture = pygame.Surface((width, height), SRCALPHA)
+        x = 0
+        for piece in pieces:
+            picture.blit(piece, (x, 0))
+            x += piece.get_width()
+
+        self.values[name] = (value, picture)
+        return picture
+
+    def rect(self, name, value):
+        """This function returns the screen rect a label and its value cover"""
+        return self.picture(name, value).get_rect(topleft=Hud.LABELS[name][1])
+
+    def draw(self, surface, name, value):
+        """This function draws a label and its value and returns the rect it drew"""
+        picture = self.picture(name, value)
+        return surface.blit(picture, Hud.LABELS[name][1])
+
+class SimulatedClock():
+    """A stand-in for pygame.time.Clock that counts ticks instead of waiting,
+        so a headless game runs as fast as the computer allows"""
+    def __init__(self):
+        self.ticks = 0
+        self.time = 0
+
+    def tick(self, framerate=0):
+        """This function advances the clock by one frame without sleeping"""
+        self.ticks += 1
+        self.time = 1000 // framerate if framerate else 0
+        return self.time
+
+    def get_time(self):
+        return self.time
+
+    def get_fps(self):
+        return 1000 / self.time if self.time else 0.0
+
 class Game():
     """ This class represents the instance of the game. Create a new instance of this
-        class to reset the game."""
+        class to reset the game. Passing a seed makes the coin, creature and star
+        placement the same every time."""
     
-    def __init__(self):
+    def __init__(self, seed=None, sound=True, dirty_rects=False, max_items=MAXITEMS,
+                 sim_rate=SIMRATE, level_file=LEVELFILE, endless=False, batch=False,
+                 swarm=1):
         # Set to True when the lives are 0 or when the player reaches the finish line
         self.game_over = False
 
         # Set to True when the user wants to restart the game
         self.restart = False
 
+        # the ending that plays once the player wins or loses, before game_over
+        # is set
+        self.transition = None
+
+        # random numbers for placing coins, creatures and stars. A seed is always
+        # picked, so a replay can make the same game again
+        if seed is None:
+            seed = random.randrange(1 << 32)
+        self.rng = random.Random(seed)
+
+        # everything needed to make the same game again
+        self.options = {'seed': seed, 'max_items': max_items, 'sim_rate': sim_rate,
+                        'level_file': level_file, 'endless': endless, 'batch': batch,
+                        'swarm': swarm}
+
+        # records the input events, if this game is being recorded
+        self.recorder = None
+
+        # times each part of the frame, when the game is run with a profiler
+        self.profiler = None
+
+        # the number of physics steps the game has run, which is the game's clock
+        self.frame = 0
+
+        # every physics step run, including after the game is over. Unlike the
+        # clock it never goes back on a restart or rewind, so replays use it
+        self.steps = 0
+
+        # the number of physics steps per second and how many frames' worth of
+        # movement each step makes
+        self.sim_rate = sim_rate
+        self.dt = FRAMERATE / sim_rate
+
         # controls when evil creatures are added
-        self.add_item_time = time.time()
+        self.add_item_frame = 0
+
+        # the level being played and the camera that scrolls across it. The
+        # camera never goes back in the endless mode
+        if endless:
+            self.level = EndlessLevel(self.rng.randrange(1 << 32))
+        else:
+            self.level = Level.load(level_file, self.rng)
+        self.camera = Camera(self.level.width, one_way=endless)
+
+        # with batch set, creatures, coins and stars are kept in numpy arrays
+        # instead of sprites, and swarm creatures and stars come with every wave
+        self.batch = batch or swarm > 1
+        self.swarm = swarm
+        if self.batch:
+            if np is None:
+                raise ImportError('the batch entity engine needs numpy')
+            capacity = max(BATCHCAPACITY, swarm * 4)
+            self.creature_batch = EntityBatch('creature.png', (50,50), capacity, 3, True)
+            self.star_batch = EntityBatch('star.png', (60,50), capacity, 8)
+            self.coin_batch = EntityBatch('coin.png', Coin.SIZE, capacity)
+            self.batches = [self.coin_batch, self.creature_batch, self.star_batch]
+        else:
+            self.coin_batch = None
+            self.batches = []
+
+        # the lives and points shown at the top of the screen
+        self.hud = Hud()
+
+        # redraw only the changed parts of the window if asked to
+        self.renderer = DirtyRenderer() if dirty_rects else None
 
         # load the winning and losing screens
-        self.winning_screen = load_image('winning_screen.png')
-        self.losing_screen = load_image('gameover_screen.png')
+        self.winning_screen = ASSETS.image('winning_screen.png')
+        self.losing_screen = ASSETS.image('gameover_screen.png')
         
         # set up the all_sprites group
         self.all_sprites = pygame.sprite.Group()
 
-        # set up the background group
-        self.background_group = pygame.sprite.Group()
-        
-        # add the background to the group
-        background_image = load_image('Background_updated.png')
-        self.background = Background(background_image)
-        self.all_sprites.add(self.background)
-        self.background_group.add(self.background)
+        # set up the background, which is drawn behind all the sprites
+        self.background = Background(ASSETS.image('Background_updated.png'),
+                                     self.level.width or MAXBG)
 
         # set up the player group
         self.kirby = pygame.sprite.Group()
@@ -287,263 +1646,384 @@ class Game():
         lives = 5
         
         # add the player to the group
-        player_image = load_image('pink_kirby.png')
-        self.player = Player(player_image,lives, 0)
+        self.player = Player(lives, 0)
         self.all_sprites.add(self.player)
         self.kirby.add(self.player)
 
         # set up and add the star to a group
         self.powerup = pygame.sprite.Group()
-        self.star_image = load_image('star.png')
-        self.star = Star(self.star_image)
-        self.all_sprites.add(self.star)
-        self.powerup.add(self.star)
+        self.powerup_index = SpatialGrid()
+        self.star_pool = SpritePool(Star, max_items, self.powerup,
+                                    self.all_sprites, self.powerup_index)
+        self.star = self.spawn_star(self.camera.x + WINDOWWIDTH)
         
-        # set up the platform group
-        self.platform_list = pygame.sprite.Group()
-        transparent_image = load_image('transparentimage.png')
-        
-        # List with width, height, x, and y of platforms
-        platform_details = [[95, 90, 515, 475],
-                            [145, 75, 645, 261],
-                            [145,65,950,184],
-                            [95,140,1040,456],
-                            [85,260,1550,332],
-                            [290,75,1995,255],
-                            [115,100,2550,467],
-                            [145,75,2740,132],
-                            [65,210,2980,380],
-                            [550,69,3300,210],
-                            [85,93,3759,476],
-                            [80,93,4225,480],
-                            [73,240,4490,342],
-                            [80,97,4810,472],
-                            [220,55,5230,285],
-                            [80,250,5705,340],
-                            [80,80,6445,485],
-                            [80,80,6530,393],
-                            [80,80,6610,310],
-                            [2055,100,0,565],
-                            [865,100,2255,565],
-                            [1260,100,3305,565],
-                            [1170,100,4757,565],
-                            [1800,100,6170,565]]
- 
-        # Go through the list above and add platforms to group
-        for platform in platform_details:
-            self.block = Obstacles(platform[0], platform[1], transparent_image)
-            self.block.rect.x = platform[2]
-            self.block.rect.y = platform[3]
-            self.platform_list.add(self.block)
-            self.all_sprites.add(self.block)
-
-        # set up the poisonous plant group
-        self.plants = pygame.sprite.Group()
-        
-        # List with width, height, x, and y of poisonous plants
-        plant_details = [[45,130,1070,330],
-                         [40,125,4240,365],
-                         [45,120,5328,330]]
-
-        # Go through the list above an add plants to group
-        for p in plant_details:
-            self.plant = Obstacles(p[0], p[1], transparent_image)
-            self.plant.rect.x = p[2]
-            self.plant.rect.y = p[3]
-            self.plants.add(self.plant)
-            self.all_sprites.add(self.plant)
-
-        # set up coin group, load image and add coins to the group
+        # set up the collision grids of the platforms, poisonous plants, coins and
+        # winning block, and the coin group. They are filled by the level stream as
+        # the camera gets near each part of the level
+        self.platform_index = SpatialGrid()
+        self.plant_index = SpatialGrid()
         self.coin_list = pygame.sprite.Group()
-        self.coin_image = load_image('coin.png')
-        for x in range (30):
-            self.coin = Coin(self.coin_image)
-            self.coin_list.add(self.coin)
-            self.all_sprites.add(self.coin)
+        self.coin_index = SpatialGrid()
+        self.win_index = SpatialGrid()
+
+        # outline the level's geometry, for debugging, when GEOMETRYKEY is pressed
+        self.show_geometry = False
 
         # set up the creature group and add creatures
         self.creatures = pygame.sprite.Group()
-        self.creature_image = load_image('creature.png')
+        self.creature_index = SpatialGrid()
+        self.creature_pool = SpritePool(Creature, max_items, self.creatures,
+                                        self.all_sprites, self.creature_index)
         for i in range(INITIALITEMS):
-            self.acreature = Creature(self.creature_image)
-            self.creatures.add(self.acreature)
-            self.all_sprites.add(self.acreature)
-
-        # create the winning block that determines if the player wins
-        self.winning_signal = pygame.sprite.Group()
-        winning_block = [[100,700,7380,200]]
-        for w in winning_block:
-            self.win_signal = Obstacles(w[0], w[1], transparent_image)
-            self.win_signal.rect.x = w[2]
-            self.win_signal.rect.y = w[3]
-            self.winning_signal.add(self.win_signal)
-            self.all_sprites.add(self.win_signal)
+            self.acreature = self.spawn_creature(self.camera.x + WINDOWWIDTH)
+
+        # load the part of the level around the camera, and see what the player
+        # starts out standing on
+        self.level_stream = LevelStream(self.level, self)
+        self.level_stream.update(self.camera.x)
+        self.update_contacts()
 
         # set up music
-        self.pickUpSound = pygame.mixer.Sound('pickup.wav')
-        self.losingSound = pygame.mixer.Sound('game_over(losing).wav')
-        self.winningSound = pygame.mixer.Sound('game_over(winning).wav')
-        self.jumpSound = pygame.mixer.Sound('jump.wav')
-        self.levelUpSound = pygame.mixer.Sound('level_up.wav')
-        self.poisonSound = pygame.mixer.Sound('plant_collision_sound.wav')
+        self.pickUpSound = ASSETS.sound('pickup.wav')
+        self.losingSound = ASSETS.sound('game_over(losing).wav')
+        self.winningSound = ASSETS.sound('game_over(winning).wav')
+        self.jumpSound = ASSETS.sound('jump.wav')
+        self.levelUpSound = ASSETS.sound('level_up.wav')
+        self.poisonSound = ASSETS.sound('plant_collision_sound.wav')
         pygame.mixer.music.load('background_music.mp3')
-        pygame.mixer.music.play(-1,0.0)
-        self.musicPlaying = True
-        
+        self.sound = sound
+        self.musicPlaying = sound
+        if self.musicPlaying:
+            pygame.mixer.music.play(-1,0.0)
+
+        # the state the game started in, for restarting it, and snapshots of the
+        # last few seconds, for rewinding it
+        self.start = self.snapshot()
+        self.rewind = deque(maxlen=REWINDSECONDS // REWINDSTEP)
+
     def process_events(self, windowSurface):
         """Process all of the keyboard and mouse events"""
-        # if the event type is to exit the program
         for event in pygame.event.get():
-                if event.type == QUIT:
-                    terminate()
-                elif event.type == KEYDOWN:
-                    # the player is moving left
-                    if event.key == K_LEFT:
-                        scrollLeft(self.player, 10)
-                        self.player.flip_head()
-                        
-                    # the player is moving right
-                    elif event.key == K_RIGHT:
-                        scrollRight(self.player, 10)
-                        
-                    # the player is jumping
-                    elif event.key == K_UP:
-                        for ablock in self.platform_list:
-                            if self.player.rect.bottom == GROUND or self.player.rect.bottom == ablock.rect.top:
-                                self.player.jump(self.platform_list)
-                                if self.musicPlaying:
-                                    self.jumpSound.play()
-                                    
-                    # the user clicks the spacebar in order to return back to restart the game
-                    elif event.key == ord(' '):
-                        if self.game_over:
-                            self.restart = True
-                    
-                elif event.type == KEYUP:
-                    if event.key == K_ESCAPE:
-                        terminate()
-                        
-                    # the player has stopped moving
-                    elif event.key == K_LEFT and self.player.x_change < 0:
-                        stop_scrolling(self.player)
-                        
-                    elif event.key == K_RIGHT and self.player.x_change > 0:
-                        stop_scrolling(self.player)
-                        self.player.flip_head()
-
-                    elif event.key == ord('m'):
-                        if self.musicPlaying:
-                            pygame.mixer.music.stop()
-                        else:
-                            pygame.mixer.music.play(-1,0.0)
-                        self.musicPlaying = not self.musicPlaying
-                        
+            if self.recorder is not None:
+                self.recorder.record(event)
+            self.handle_event(event)
+
+    def handle_event(self, event):
+        """This function reacts to a single keyboard or window event"""
+        # if the event type is to exit the program
+        if event.type == QUIT:
+            terminate()
+        elif event.type == KEYDOWN:
+            # the player is moving left
+            if event.key == K_LEFT:
+                scrollLeft(self.player, RUNSPEED)
+                self.player.flip_head()
+
+            # the player is moving right
+            elif event.key == K_RIGHT:
+                scrollRight(self.player, RUNSPEED)
+
+            # the player is jumping
+            elif event.key == K_UP:
+                if self.player.jump() and self.musicPlaying:
+                    self.jumpSound.play()
+
+            # the user clicks the spacebar in order to return back to restart the game
+            elif event.key == ord(' '):
+                if self.game_over:
+                    self.restart = True
+
+            # start the game over on the spot
+            elif event.key == RESTARTKEY:
+                self.start_over()
+
+            # go back to the last snapshot at least REWINDSTEP seconds ago, even
+            # from the ending
+            elif event.key == REWINDKEY:
+                while self.rewind and self.rewind[-1]['frame'] > self.frame - self.sim_rate * REWINDSTEP:
+                    self.rewind.pop()
+                if self.rewind:
+                    ended = self.transition is not None or self.game_over
+                    self.restore(self.rewind.pop())
+                    if ended and self.transition is None:
+                        self.resume_music()
+
+            # show or hide the outlines of the level's geometry
+            elif event.key == GEOMETRYKEY:
+                self.show_geometry = not self.show_geometry
+                if self.renderer:
+                    self.renderer.camera_x = None
+
+            # show or hide the profiler overlay, and redraw the whole window so
+            # the dirty renderer doesn't leave it behind
+            elif event.key == PROFILEKEY and self.profiler is not None:
+                self.profiler.visible = not self.profiler.visible
+                if self.renderer:
+                    self.renderer.camera_x = None
+
+        elif event.type == KEYUP:
+            if event.key == K_ESCAPE:
+                terminate()
+
+            # the player has stopped moving
+            elif event.key == K_LEFT and self.player.x_change < 0:
+                stop_scrolling(self.player)
+
+            elif event.key == K_RIGHT and self.player.x_change > 0:
+                stop_scrolling(self.player)
+                self.player.flip_head()
+
+            elif event.key == ord('m'):
+                if self.musicPlaying:
+                    pygame.mixer.music.stop()
+                else:
+                    pygame.mixer.music.play(-1,0.0)
+                self.musicPlaying = not self.musicPlaying
 
     def run_logic(self, windowSurface):
         """This function runs the logic of the game"""
+        self.steps += 1
         if not self.game_over:
+            self.frame += 1
+
+            # once the game is decided, the world stands still while the ending plays
+            if self.transition is not None:
+                if self.transition.update():
+                    self.game_over = True
+                return
 
-            # Make sure the player doesn't move past the right side of the screen
-            if self.player.rect.right > WINDOWWIDTH/2:
-                self.player.rect.right = WINDOWWIDTH/2
-     
-            # Make sure the player doesn't move past the left side of the screen
-            elif self.player.rect.left < 100:
-                self.player.rect.left = 100
+            # Make sure the player doesn't move past the right end of the world
+            if self.level.width and self.player.rect.right > self.level.width:
+                self.player.rect.right = self.level.width
+
+            # Make sure the player doesn't move past the left end of the world, or
+            # back off the screen in the endless mode
+            elif self.player.rect.left < max(100, self.camera.x):
+                self.player.rect.left = max(100, self.camera.x)
 
             # Make sure the player remains on the ground, otherwise the game is over
             if self.player.rect.bottom >= WINDOWHEIGHT:
                 self.player.lives = 0
 
-            # Scroll the background, platforms, enemies and coins
-            for ablock in self.platform_list:
-                for w in self.winning_signal:
-                    for acoin in self.coin_list:
-                        for aplant in self.plants:
-                            # scroll everything right if the player moves left
-                            if self.player.x_change < 0:
-                                if self.player.rect.x >= WINDOWWIDTH/4:
-                                    scrollRight(self.background, 5)
-                                    scrollRight(ablock, 5)
-                                    scrollRight(w, 5)
-                                    scrollRight(acoin, 5)
-                                    scrollRight(aplant, 5)
-
-                            # scroll everything left if the player moves right
-                            elif self.player.x_change > 0:
-                                scrollLeft(self.background, 5)
-                                scrollLeft(ablock, 5)
-                                scrollLeft(w, 5)
-                                scrollLeft(acoin, 5)
-                                scrollLeft(aplant, 5)
-
-                            # stop scrolling everything if the player stops moving
-                            # also don't scroll if the player is in a certain screen range
-                            elif self.player.rect.right < WINDOWWIDTH and self.player.rect.left > 0:
-                                if self.player.x_change == 0:
-                                    stop_scrolling(self.background)
-                                    stop_scrolling(ablock)
-                                    stop_scrolling(w)
-                                    stop_scrolling(acoin)
-                                    stop_scrolling(aplant)
-
+            # Scroll the camera so the player stays in view, and load the parts of
+            # the level near it
+            self.camera.follow(self.player)
+            self.level_stream.update(self.camera.x)
 
             # check for collisions between coins and player and add points
-            coin_hit_list = pygame.sprite.spritecollide(self.player, self.coin_list, True)
+            if self.batch:
+                coin_hit_list = self.coin_batch.collide(self.player.rect)
+            else:
+                coin_hit_list = [c.key for c in self.coin_index.spritecollide(self.player, True)]
             for c in coin_hit_list:
+                self.level_stream.collect(c)
                 self.player.points += 1
                 if self.musicPlaying:
                     self.pickUpSound.play()
 
             # Check for collisions between Kirby and powerups, add a life
-            power_up_collected = pygame.sprite.spritecollide(self.player, self.powerup, True)
+            if self.batch:
+                power_up_collected = self.star_batch.collide(self.player.rect)
+            else:
+                power_up_collected = self.powerup_index.spritecollide(self.player)
+            for astar in power_up_collected:
+                if not self.batch:
+                    self.star_pool.release(astar)
             if len(power_up_collected) > 0:
                 self.player.lives += 1
                 if self.musicPlaying:
                     self.levelUpSound.play()
                    
             # check for collisions between plants and player, instantly die
-            plant_hit_list = pygame.sprite.spritecollide(self.player, self.plants, False)
+            plant_hit_list = self.plant_index.spritecollide(self.player)
             for p in plant_hit_list:
                 self.player.lives = 0
                     
             # Add new creatures and powerups when the time is right
-            end_item_time = time.time()
-            if end_item_time - self.add_item_time >= NEWITEMS:
-                self.add_item_time = time.time()
-                acreature = Creature(self.creature_image)
-                astar = Star(self.star_image)
-                self.creatures.add(acreature)
-                self.powerup.add(astar)
-                self.all_sprites.add(acreature, astar)
+            if self.frame - self.add_item_frame >= NEWITEMS * self.sim_rate:
+                self.add_item_frame = self.frame
+                for i in range(self.swarm):
+                    # a swarm is spread out across a screen's width
+                    x = self.camera.x + WINDOWWIDTH
+                    if i > 0:
+                        x += self.rng.randrange(0, WINDOWWIDTH)
+                    self.spawn_creature(x)
+                    self.spawn_star(x)
 
             # Check for collisions between Kirby and creatures
-            creature_hit_list = pygame.sprite.spritecollide(self.player, self.creatures, True)
+            if self.batch:
+                creature_hit_list = self.creature_batch.collide(self.player.rect)
+            else:
+                creature_hit_list = self.creature_index.spritecollide(self.player)
+            for acreature in creature_hit_list:
+                if not self.batch:
+                    self.creature_pool.release(acreature)
             if len(creature_hit_list) > 0:
                 self.player.lives -= 1
                 if self.musicPlaying:
                     self.poisonSound.play()
 
             # check if the player collides with the winning block (player wins)
-            did_player_win = pygame.sprite.spritecollide(self.player, self.winning_signal, True)
+            did_player_win = self.win_index.spritecollide(self.player)
             if len(did_player_win) > 0:
                 pygame.mixer.music.stop()
                 if self.musicPlaying:
                     self.winningSound.play()
-                    time.sleep(5)
                     self.musicPlaying = False
-                self.game_over = True
+                self.transition = Transition(self.winning_screen, WINTRANSITION, self.sim_rate)
 
             # check if the player loses (game over)
-            if self.player.lives == 0 or self.player.rect.bottom == WINDOWHEIGHT:
+            elif self.player.lives == 0 or self.player.rect.bottom == WINDOWHEIGHT:
                 pygame.mixer.music.stop()
-                self.game_over = True
                 if self.musicPlaying:
                     self.losingSound.play()
                     self.musicPlaying = False
-    
-    def display_frame(self, windowSurface):
-        """This function displays the images onto the screen and creates a scrolling background"""
+                self.transition = Transition(self.losing_screen, LOSETRANSITION, self.sim_rate)
+
+            # remember this moment, so it can be rewound to
+            if self.frame % (self.sim_rate * REWINDSTEP) == 0:
+                self.rewind.append(self.snapshot())
+
+    def snapshot(self):
+        """This function returns the state of the simulation as plain data: the
+            clock and spawn timer, the random number state, the player, the camera,
+            the live creatures and stars and the coins already taken. The level
+            itself comes from its file or seed, so it isn't saved. Snapshots can be
+            pickled, and restore takes them back even after a trip through JSON"""
+        player = self.player
+        state = {'frame': self.frame,
+                 'add_item_frame': self.add_item_frame,
+                 'rng': self.rng.getstate(),
+                 'game_over': self.game_over,
+                 'transition': None,
+                 'player': (player.rect.x, player.rect.y, player.x_change, player.y_change,
+                            player.x_fraction, player.y_fraction, player.lives, player.points,
+                            player.flipped),
+                 'camera': self.camera.x,
+                 'creatures': [(c.rect.x, c.rect.y, c.y_change, c.x_fraction, c.y_fraction)
+                               for c in self.creatures],
+                 'stars': [(s.rect.x, s.rect.y, s.x_fraction) for s in self.powerup],
+                 'used': list(self.level_stream.used)}
+        if self.transition is not None:
+            state['transition'] = (self.transition.screen is self.winning_screen,
+                                   self.transition.step)
+        if self.batch:
+            state['creature_batch'] = self.creature_batch.snapshot()
+            state['star_batch'] = self.star_batch.snapshot()
+        return state
+
+    def restore(self, state):
+        """This function puts the game back in the state a snapshot was taken in"""
+        self.frame = state['frame']
+        self.add_item_frame = state['add_item_frame']
+        self.game_over = state['game_over']
+        self.transition = None
+        if state['transition'] is not None:
+            won, step = state['transition']
+            if won:
+                self.transition = Transition(self.winning_screen, WINTRANSITION, self.sim_rate)
+            else:
+                self.transition = Transition(self.losing_screen, LOSETRANSITION, self.sim_rate)
+            self.transition.step = step
+
+        player = self.player
+        (player.rect.x, player.rect.y, player.x_change, player.y_change, player.x_fraction,
+         player.y_fraction, player.lives, player.points, flipped) = state['player']
+        if player.flipped != flipped:
+            player.flip_head()
+        player.previous = None
+        self.camera.x = self.camera.previous_x = self.camera.view_x = state['camera']
+
+        # the pools hand out sprites again in the order they were saved in
+        for sprite in self.creatures.sprites():
+            self.creature_pool.release(sprite)
+        for x, y, y_change, x_fraction, y_fraction in state['creatures']:
+            sprite = self.creature_pool.spawn(x, self.rng)
+            sprite.rect.topleft = (x, y)
+            sprite.y_change = y_change
+            sprite.x_fraction = x_fraction
+            sprite.y_fraction = y_fraction
+            self.creature_index.move(sprite)
+        for sprite in self.powerup.sprites():
+            self.star_pool.release(sprite)
+        for x, y, x_fraction in state['stars']:
+            sprite = self.star_pool.spawn(x, self.rng)
+            sprite.rect.topleft = (x, y)
+            sprite.x_fraction = x_fraction
+            self.powerup_index.move(sprite)
+        if self.batch:
+            self.creature_batch.restore(state['creature_batch'])
+            self.star_batch.restore(state['star_batch'])
+
+        # JSON turns the tuples in the keys and random state into lists
+        used = [tuple(key) if isinstance(key, list) else key for key in state['used']]
+        self.level_stream.reload(used, self.camera.x)
+        self.update_contacts()
+        version, internal, gauss = state['rng']
+        self.rng.setstate((version, tuple(internal), gauss))
+
+        # the whole window has to be drawn again
+        if self.renderer:
+            self.renderer.camera_x = None
+
+    def update_contacts(self):
+        """This function senses what the player and creatures rest against where
+            they are now, for when they were placed rather than moved there"""
+        for sprite in [self.player] + self.creatures.sprites():
+            sense_contacts(sprite, self.platform_index.query(sprite.rect.inflate(2, 2)))
+
+    def start_over(self):
+        """This function restarts the game from its first step, without loading it again"""
+        ended = self.transition is not None or self.game_over
+        self.restore(self.start)
+        self.rewind.clear()
+        if ended:
+            self.resume_music()
+
+    def resume_music(self):
+        """This function starts the music again after an ending stopped it"""
+        if self.sound and not self.musicPlaying:
+            pygame.mixer.music.play(-1,0.0)
+            self.musicPlaying = True
+
+    def spawn_creature(self, x):
+        """This function lets a creature loose at world position x and returns it,
+            or returns None if there is no room for another one"""
+        if self.batch:
+            return self.creature_batch.spawn(x, self.rng.randrange(0, GROUND - 50))
+        return self.creature_pool.spawn(x, self.rng)
+
+    def spawn_star(self, x):
+        """This function sends a shooting star from world position x and returns it,
+            or returns None if there is no room for another one"""
+        if self.batch:
+            return self.star_batch.spawn(x, self.rng.randrange(0, 200))
+        return self.star_pool.spawn(x, self.rng)
+
+    def platform_rects(self):
+        """This function returns the loaded platforms as an array of
+            [left, top, right, bottom] rows for the batch entity engine"""
+        rects = [(block.rect.left, block.rect.top, block.rect.right, block.rect.bottom)
+                 for block in self.platform_index]
+        return np.array(rects, dtype=np.float64).reshape(-1, 4)
+
+    def display_frame(self, windowSurface, alpha=1.0):
+        """This function displays the images onto the screen and creates a scrolling
+            background. alpha says how far between the last two physics steps the
+            moving sprites are drawn"""
+        self.camera.interpolate(alpha)
+        if self.renderer:
+            self.renderer.render(self, windowSurface)
+            return
+
+        self.draw(windowSurface)
+
+        # update the screen
+        pygame.display.update()
+
+    def draw(self, windowSurface):
+        """This function draws the current frame onto a surface and returns the
+            rects of the HUD"""
         if self.game_over:
             # display the losing screen if the player loses
             if self.player.lives == 0:
@@ -551,45 +2031,79 @@ class Game():
             # display the winning screen if the player wins
             elif self.player.lives > 0:
                 windowSurface.blit(self.winning_screen, (0,0))
-
-        else:
-            self.all_sprites.draw(windowSurface)
-            basicFont = pygame.font.SysFont("Arial Black",40)
-            displaylives = ["Lives: " + str(self.player.lives)]
-            for i in range(len(displaylives)):
-                drawText(displaylives[i], basicFont, windowSurface, 10,0, PINK)
-            displaypoints = ["Points: " + str(self.player.points)]
-            for x in range(len(displaypoints)):
-                drawText(displaypoints[x], basicFont, windowSurface, 675,0, PINK)                
-
-        # update the screen
-        pygame.display.update()
+            return []
+
+        self.background.draw(windowSurface, self.camera)
+        self.camera.draw(self.all_sprites, windowSurface)
+        for entities in self.batches:
+            entities.draw(windowSurface, self.camera)
+        if self.show_geometry:
+            self.draw_geometry(windowSurface)
+        hud_rects = self.draw_hud(windowSurface)
+        if self.transition is not None:
+            self.transition.draw(windowSurface, self.camera.alpha)
+        if self.profiler is not None and self.profiler.visible:
+            self.profiler.draw(windowSurface)
+        return hud_rects
+
+    def draw_geometry(self, windowSurface):
+        """This function outlines the platforms, plants and winning block in view"""
+        view = pygame.Rect(self.camera.view_x, 0, WINDOWWIDTH, WINDOWHEIGHT)
+        for index, colour in GEOMETRYCOLOURS:
+            for block in getattr(self, index).query(view):
+                pygame.draw.rect(windowSurface, colour, self.camera.apply(block.rect), 2)
+
+    def hud_rects(self):
+        """This function returns the rects the lives and points cover"""
+        return [self.hud.rect('lives', self.player.lives),
+                self.hud.rect('points', self.player.points)]
+
+    def draw_hud(self, windowSurface):
+        """This function draws the lives and points and returns the rects it drew"""
+        return [self.hud.draw(windowSurface, 'lives', self.player.lives),
+                self.hud.draw(windowSurface, 'points', self.player.points)]
 
     def update_sprites(self):
         """This function updates all the sprites in the game loop"""
         if not self.game_over:
+            # remember where everything was, so frames can be drawn in between steps
+            self.camera.previous_x = self.camera.x
+            self.player.previous = self.player.rect.topleft
+            for sprite in self.creatures:
+                sprite.previous = sprite.rect.topleft
+            for sprite in self.powerup:
+                sprite.previous = sprite.rect.topleft
+
+            # nothing moves while the ending plays
+            if self.transition is not None:
+                return
+
             # update the player
-            self.player.update(self.platform_list)
+            self.player.update(self.platform_index, self.dt)
 
-            # update the evil creaures
-            self.creatures.update(self.platform_list)
+            # update the evil creaures and move them to their new cells
+            self.creatures.update(self.platform_index, self.dt)
+            for acreature in self.creatures:
+                self.creature_index.move(acreature)
 
             # update the power up (star)
-            self.powerup.update()
-            
-            # update the background
-            self.background.update()
-
-            # update the pipes, platforms and winning block
-            self.platform_list.update()
-            self.winning_signal.update()
-
-            # update the poisonous plants
-            self.plants.update()
-
-            # update the coins
-            self.coin_list.update()
-            
+            self.powerup.update(self.dt)
+            for astar in self.powerup:
+                self.powerup_index.move(astar)
+
+            # move the batched creatures and stars all at once
+            if self.batch:
+                platforms = self.platform_rects()
+                for entities in self.batches:
+                    entities.step(platforms, self.dt)
+
+                # coins belong to the level stream, which kills them when their chunk unloads
+                self.creature_batch.cull(self.camera.x)
+                self.star_batch.cull(self.camera.x)
+
+            # recycle the creatures and stars that have left the screen
+            self.creature_pool.cull(self.camera.x)
+            self.star_pool.cull(self.camera.x)
                     
 def load_image(filename):
     """This function loads an image"""
@@ -597,91 +2111,997 @@ def load_image(filename):
     image = image.convert_alpha()
     return image
 
-def drawText(text, font, surface, x, y, textcolour):
-    """ Draws the text on the surface at the location specified """
-    textobj = font.render(text, 1, textcolour)
-    textrect = textobj.get_rect()
-    textrect.topleft = (x, y)
-    surface.blit(textobj, textrect)
-
-def display_menu(windowSurface):
-    """This function blits the opening screen image onto the windowSurface"""
-    opening_image = load_image('opening_screen.png')
+class AssetManager():
+    """Loads every image and sound once per process and remembers scaled and flipped
+        copies of images, so restarting a game or opening a menu doesn't have to
+        decode or scale anything again. The sprite images are packed into one
+        atlas surface and handed out as subsurfaces of it. The surfaces it hands
+        out are shared, so they must never be drawn on"""
+    def __init__(self):
+        self.images = {}
+        self.scaled_images = {}
+        self.atlas = None
+        self.atlas_frames = {}
+        self.sounds = {}
+        self.fonts = {}
+
+    def image(self, filename):
+        """This function returns a loaded image, loading it the first time"""
+        if filename not in self.images:
+            self.images[filename] = load_image(filename)
+        return self.images[filename]
+
+    def scaled(self, filename, size, flip=False):
+        """This function returns an image scaled to size and optionally flipped
+            left to right, scaling it the first time"""
+        key = (filename, tuple(size), flip)
+        if key not in self.scaled_images:
+            image = pygame.transform.scale(self.image(filename), size)
+            if flip:
+                image = pygame.transform.flip(image, True, False)
+            self.scaled_images[key] = image
+        return self.scaled_images[key]
+
+    def frame(self, filename, size, flip=False):
+        """This function returns an image scaled to size and optionally flipped left
+            to right, as a subsurface of the sprite atlas. Images that aren't in
+            ATLASFRAMES are scaled on their own"""
+        if self.atlas is None:
+            self.build_atlas()
+        key = (filename, tuple(size), flip)
+        if key in self.atlas_frames:
+            return self.atlas_frames[key]
+        return self.scaled(filename, size, flip)
+
+    def build_atlas(self):
+        """This function packs every ATLASFRAMES image, facing both ways, side by
+            side into the atlas"""
+        keys = [(filename, tuple(size), flip) for filename, size in ATLASFRAMES
+                for flip in (False, True)]
+        width = sum(size[0] for filename, size, flip in keys)
+        height = max(size[1] for filename, size, flip in keys)
+        self.atlas = pygame.Surface((width, height), SRCALPHA).convert_alpha()
+        x = 0
+        for key in keys:
+            # the scaled copy is only needed until it is packed
+            image = self.scaled(*key)
+            del self.scaled_images[key]
+
+            # the atlas starts out clear, so taking the larger of each channel
+            # copies the image's pixels and transparency exactly
+            self.atlas.blit(image, (x, 0), special_flags=BLEND_RGBA_MAX)
+            self.atlas_frames[key] = self.atlas.subsurface((x, 0) + image.get_size())
+            x += image.get_width()
+
+    def font(self, name, size):
+        """This function returns a system font, looking it up the first time"""
+        key = (name, size)
+        if key not in self.fonts:
+            self.fonts[key] = pygame.font.SysFont(name, size)
+        return self.fonts[key]
+
+    def sound(self, filename):
+        """This function returns a sound, decoding it the first time"""
+        if filename not in self.sounds:
+            self.sounds[filename] = pygame.mixer.Sound(filename)
+        return self.sounds[filename]
+
+# the asset manager shared by the whole game
+ASSETS = AssetManager()
+
+def decode_image(filename, sizes):
+    """This function loads an image and scales it to each (size, flip) in sizes. It
+        runs on the preloader's threads, so it leaves converting the surfaces for
+        the display to the main thread"""
+    image = pygame.image.load(filename)
+    scaled = []
+    for size, flip in sizes:
+        picture = pygame.transform.scale(image, size)
+        if flip:
+            picture = pygame.transform.flip(picture, True, False)
+        scaled.append(((size, flip), picture))
+    return image, scaled
+
+class AssetPreloader():
+    """Decodes images and sounds, and scales the sprite images to their ATLASFRAMES
+        sizes, on a pool of threads. poll hands whatever has finished to the asset
+        manager, so the menu can keep responding and show progress while the game's
+        assets load, and Game() then finds them all ready"""
+    def __init__(self, assets, images=PRELOADIMAGES, sounds=PRELOADSOUNDS,
+                 workers=PRELOADWORKERS):
+        self.assets = assets
+        self.executor = ThreadPoolExecutor(workers)
+        sizes = {}
+        for filename, size in ATLASFRAMES:
+            sizes.setdefault(filename, []).extend([(tuple(size), False), (tuple(size), True)])
+        self.pending = []
+        for filename in images:
+            future = self.executor.submit(decode_image, filename, sizes.get(filename, []))
+            self.pending.append(('image', filename, future))
+        for filename in sounds:
+            self.pending.append(('sound', filename, self.executor.submit(pygame.mixer.Sound, filename)))
+        self.total = len(self.pending)
+
+    def poll(self):
+        """This function stores the assets that have finished loading and returns
+            how much of the loading is done, from 0 to 1"""
+        still_pending = []
+        for kind, filename, future in self.pending:
+            if not future.done():
+                still_pending.append((kind, filename, future))
+            elif kind == 'sound':
+                self.assets.sounds.setdefault(filename, future.result())
+            else:
+                # surfaces can only be converted for the display on the main thread
+                image, scaled = future.result()
+                if filename not in self.assets.images:
+                    self.assets.images[filename] = image.convert_alpha()
+                for (size, flip), picture in scaled:
+                    key = (filename, size, flip)
+                    if self.assets.atlas is None and key not in self.assets.scaled_images:
+                        self.assets.scaled_images[key] = picture.convert_alpha()
+        self.pending = still_pending
+        if not self.pending:
+            self.executor.shutdown()
+        return 1 - len(self.pending) / self.total if self.total else 1.0
+
+    def finish(self):
+        """This function waits for everything to load"""
+        for kind, filename, future in self.pending:
+            future.result()
+        self.poll()
+
+def display_menu(windowSurface, progress=None):
+    """This function blits the opening screen image onto the windowSurface. If the
+        assets are still loading, a bar along the bottom shows how far along they are"""
+    opening_image = ASSETS.image('opening_screen.png')
     windowSurface.blit(opening_image, (0,0))
+    if progress is not None and progress < 1:
+        pygame.draw.rect(windowSurface, PINK, (0, WINDOWHEIGHT - 8, int(WINDOWWIDTH * progress), 8))
     pygame.display.update()
 
-def user_input(image, windowSurface):
-    """Checking for user input for the control/credit screen"""
-    windowSurface.blit(image, (0,0))
-    pygame.display.update()
-    while True:
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                terminate()
-            elif event.type == KEYDOWN:
-                if event.key == ord('X'):
-                    terminate()
-                elif event.key == ord(' '):
-                    return False
+def display_screen(screen, windowSurface, progress=None):
+    """This function shows the menu, controls or credits screen"""
+    if screen == MENU:
+        display_menu(windowSurface, progress)
+    else:
+        windowSurface.blit(ASSETS.image(SCREENIMAGES[screen]), (0,0))
+        pygame.display.update()
+
+def allow_events(event_types):
+    """This function makes pygame drop every event except the types given, so the
+        event queue only wakes the game up for events it cares about"""
+    pygame.event.set_blocked(None)
+    pygame.event.set_allowed(event_types)
+
+def user_input(event):
+    """Checking for user input for the control/credit screen. Returns the screen
+        to show next, or None to stay on this one"""
+    if event.type == QUIT:
+        terminate()
+    elif event.type == KEYDOWN:
+        if event.key == ord('X'):
+            terminate()
+        elif event.key == ord(' '):
+            return MENU
+    return None
     
-def menu_input(windowSurface):
-    """Checking for user input, mousebuttondown"""
-    while True:
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                terminate()
-            elif event.type == MOUSEBUTTONUP:
-                if event.pos[0] >= 675 and event.pos[1] >= 475 and event.pos[0] <= 885 and event.pos[1] <= 535:
-                    response = True
-                    return response
-                elif event.pos[0] >= 500 and event.pos[1] >= 550 and event.pos[0] <= 900 and event.pos[1] <= 610:
-                    controls_image = load_image('controls_image.png')
-                    response = user_input(controls_image, windowSurface)
-                    return response
-                elif event.pos[0] >= 650 and event.pos[1] >= 617 and event.pos[0] <= 885 and event.pos[1] <= 674:
-                    credits_image = load_image('credits-game.png')
-                    response = user_input(credits_image, windowSurface)
-                    return response
-            elif event.type == KEYDOWN:
-                if event.key == ord('X'):
-                    terminate()
-def main():
-    """The mainline for the game"""
-    # set up pygame
+def menu_input(event):
+    """Checking for user input, mousebuttondown. Returns the screen to show next,
+        or None to stay on the menu"""
+    if event.type == QUIT:
+        terminate()
+    elif event.type == MOUSEBUTTONUP:
+        if event.pos[0] >= 675 and event.pos[1] >= 475 and event.pos[0] <= 885 and event.pos[1] <= 535:
+            return PLAYING
+        elif event.pos[0] >= 500 and event.pos[1] >= 550 and event.pos[0] <= 900 and event.pos[1] <= 610:
+            return CONTROLS
+        elif event.pos[0] >= 650 and event.pos[1] >= 617 and event.pos[0] <= 885 and event.pos[1] <= 674:
+            return CREDITS
+    elif event.type == KEYDOWN:
+        if event.key == ord('X'):
+            terminate()
+    return None
+
+def setup_pygame(headless=False):
+    """This function sets up pygame and the window. In headless mode SDL's dummy
+        video and audio drivers are used, so no window is opened"""
+    if headless:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        os.environ['SDL_AUDIODRIVER'] = 'dummy'
     pygame.init()
-    mainClock = pygame.time.Clock()
 
     # set up the windowSurface
     windowSurface = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT),0,32)
     pygame.display.set_caption('Run Kirby Run!')
-
+    return windowSurface
+
+class FrameCapture():
+    """Saves the frames drawn on a surface to disk. capture only copies the
+        surface's pixels into a bounded queue, and a worker thread converts and
+        writes them, so the game loop never waits on encoding or the disk. When
+        the queue is full a frame is dropped, or waited for if blocking is set,
+        which headless runs use so that no frame is ever lost"""
+    def __init__(self, path, surface, blocking=False, size=CAPTUREQUEUE):
+        self.path = path
+        self.size = surface.get_size()
+        self.depth = surface.get_bitsize()
+        self.masks = surface.get_masks()
+        self.blocking = blocking
+        self.frames = queue.Queue(size)
+        self.count = 0
+        self.dropped = 0
+        self.error = None
+        if path.endswith(CAPTURERAW):
+            self.output = open(path, 'wb')
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.output = None
+        self.worker = threading.Thread(target=self.write_frames, daemon=True)
+        self.worker.start()
+        EXIT_HOOKS.append(self.close)
+
+    def capture(self, surface):
+        """This function queues a copy of the surface's pixels to be written"""
+        # a straight copy of the pixel buffer, with no conversion on this thread
+        pixels = surface.get_buffer().raw
+        try:
+            self.frames.put((self.count, pixels), self.blocking)
+            self.count += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def write_frames(self):
+        """This function runs on the worker thread and writes queued frames until
+            it is handed None"""
+        frame = pygame.Surface(self.size, 0, self.depth, self.masks)
+        while True:
+            item = self.frames.get()
+            if item is None:
+                return
+
+            # keep emptying the queue after an error so capture never blocks for good
+            if self.error is not None:
+                continue
+            number, pixels = item
+            try:
+                frame.get_buffer().write(pixels)
+                if self.output is not None:
+                    self.output.write(pygame.image.tobytes(frame, 'RGB'))
+                else:
+                    pygame.image.save(frame, os.path.join(self.path, CAPTURENAME % number))
+            except (OSError, pygame.error) as error:
+                self.error = error
+
+    def close(self):
+        """This function waits for the queued frames to be written, closes the
+            output and prints how many frames were saved"""
+        if self.close in EXIT_HOOKS:
+            EXIT_HOOKS.remove(self.close)
+        self.frames.put(None)
+        self.worker.join()
+        if self.output is not None:
+            self.output.close()
+        print('%s: %d frames of %dx%d captured, %d dropped%s'
+              % (self.path, self.count, self.size[0], self.size[1], self.dropped,
+                 '' if self.error is None else ', failed: %s' % self.error))
+
+def run_headless(windowSurface, frames, seed=None, max_items=MAXITEMS, sim_rate=SIMRATE,
+                 level_file=LEVELFILE, endless=False, batch=False, swarm=1, record=None,
+                 capture=None):
+    """This function steps a game without drawing it, as fast as possible,
+        until it is over or the number of physics steps has run. If record is a
+        file name, the game is saved there as a replay. If capture is a path,
+        every step is drawn and saved there"""
+    game = Game(seed, sound=False, max_items=max_items, sim_rate=sim_rate,
+                level_file=level_file, endless=endless, batch=batch, swarm=swarm)
+    recorder = None
+    if record:
+        recorder = ReplayRecorder(game, record)
+    if capture:
+        capture = FrameCapture(capture, windowSurface, blocking=True)
+    mainClock = SimulatedClock()
+    while mainClock.ticks < frames and not game.game_over:
+        game.process_events(windowSurface)
+        game.update_sprites()
+        game.run_logic(windowSurface)
+        if capture:
+            game.display_frame(windowSurface)
+            capture.capture(windowSurface)
+        mainClock.tick(sim_rate)
+    if recorder is not None:
+        recorder.save()
+    if capture:
+        capture.close()
+    return game
+
+class ReplayRecorder():
+    """Records the input events a game consumes, with the physics step each one
+        arrived on, and saves them with the game's options and final state in a
+        compact binary replay file. The replay is saved when save is called or
+        when the game exits"""
+    def __init__(self, game, filename):
+        self.game = game
+        self.filename = filename
+        self.events = bytearray()
+        game.recorder = self
+        EXIT_HOOKS.append(self.save)
+
+    def record(self, event):
+        """This function records an event, if it is a type that is replayed"""
+        code = REPLAYEVENTS.get(event.type)
+        if code is not None:
+            self.events += REPLAYEVENT.pack(self.game.steps, code, event.key)
+
+    def save(self):
+        """This function writes the replay file"""
+        if self.save in EXIT_HOOKS:
+            EXIT_HOOKS.remove(self.save)
+        options = json.dumps(self.game.options).encode()
+        data = (REPLAYMAGIC + struct.pack('<I', len(options)) + options +
+                struct.pack('<I', len(self.events) // REPLAYEVENT.size) + self.events +
+                REPLAYSTATE.pack(*game_state(self.game)))
+        with open(self.filename, 'wb') as replay_file:
+            replay_file.write(data + REPLAYCHECKSUM.pack(zlib.crc32(data)))
+
+def game_state(game):
+    """This function returns the state a replay checks: the steps run, the
+        physics step, points, lives and the player's position"""
+    return (game.steps, game.frame, game.player.points, game.player.lives,
+            game.player.rect.x, game.player.rect.y)
+
+def load_replay(filename):
+    """This function reads a replay file and returns (options, events, state),
+        where events is a list of (step, event type, key)"""
+    with open(filename, 'rb') as replay_file:
+        data = replay_file.read()
+    body = data[:-REPLAYCHECKSUM.size]
+    if (not data.startswith(REPLAYMAGIC) or len(data) < len(REPLAYMAGIC) + REPLAYCHECKSUM.size or
+            REPLAYCHECKSUM.unpack(data[-REPLAYCHECKSUM.size:])[0] != zlib.crc32(body)):
+        raise ValueError('%s is not a replay file or is damaged' % filename)
+    position = len(REPLAYMAGIC)
+    length, = struct.unpack_from('<I', body, position)
+    position += 4
+    options = json.loads(body[position:position + length].decode())
+    position += length
+    count, = struct.unpack_from('<I', body, position)
+    position += 4
+    types = dict((code, event_type) for event_type, code in REPLAYEVENTS.items())
+    events = []
+    for step, code, key in REPLAYEVENT.iter_unpack(body[position:position + count * REPLAYEVENT.size]):
+        events.append((step, types[code], key))
+    position += count * REPLAYEVENT.size
+    return options, events, REPLAYSTATE.unpack_from(body, position)
+
+def run_replay(windowSurface, filename, capture=None):
+    """This function plays a replay file back without drawing it, as fast as
+        possible, and returns (game, expected state). The game's events are fed in
+        after the same number of steps they were recorded after, and stepping
+        goes on past restarts, rewinds and the game ending until as many steps
+        have run as were recorded. If capture is a path, every step is drawn and
+        saved there"""
+    options, events, expected = load_replay(filename)
+    game = Game(sound=False, **options)
+    if capture:
+        capture = FrameCapture(capture, windowSurface, blocking=True)
+    end = expected[0]
+    next_event = 0
     while True:
-        start_game = False
-        while not start_game:
-            # display the menu screen and get user input
-            display_menu(windowSurface)
-            start_game = menu_input(windowSurface)
-        
-        # instantiate a game
-        game = Game()
-
-        # run the game loop until the user quits
-        while not game.restart:
-           # check for the QUIT event
-           game.process_events(windowSurface)
-
-           # update the sprites in the game
-           game.update_sprites()
-
-           # run logic
-           game.run_logic(windowSurface)
-
-           # draw the current frame
-           game.display_frame(windowSurface)
-
-           # keep the clock going
-           mainClock.tick(FRAMERATE)
+        # events arrive before the step they were recorded on
+        while next_event < len(events) and events[next_event][0] <= game.steps:
+            step, event_type, key = events[next_event]
+            next_event += 1
+
+            # a recorded game usually ends with ESC, which would quit the playback
+            if event_type == KEYUP and key == K_ESCAPE:
+                continue
+            game.handle_event(pygame.event.Event(event_type, key=key))
+        if game.steps >= end:
+            break
+        game.update_sprites()
+        game.run_logic(windowSurface)
+        if capture:
+            game.display_frame(windowSurface)
+            capture.capture(windowSurface)
+    if capture:
+        capture.close()
+    return game, expected
+
+class FixedTimestep():
+    """Runs a game's physics in fixed steps of 1/sim_rate seconds however fast
+        frames are drawn. If drawing falls behind, up to MAXFRAMESKIP frames' worth
+        of steps are run before the next frame, and any time still owed after that
+        is dropped so the game never spirals"""
+    def __init__(self, game, fps=FRAMERATE):
+        self.game = game
+        self.step = 1.0 / game.sim_rate
+
+        # a frame normally needs sim_rate / fps steps, so the catch-up limit
+        # grows with it and any sim rate keeps up with any frame rate
+        self.max_steps = MAXFRAMESKIP
+        if fps:
+            self.max_steps *= max(1, math.ceil(game.sim_rate / fps))
+        self.accumulator = 0.0
+        self.last_time = time.perf_counter()
+
+    def run_frame(self, windowSurface):
+        """This function handles the events, physics and drawing of one frame"""
+        game = self.game
+        now = time.perf_counter()
+        self.accumulator += now - self.last_time
+        self.last_time = now
+
+        # check for the QUIT event
+        self.timed('process_events', game.process_events, windowSurface)
+
+        # run as many physics steps as the time since the last frame needs
+        steps = 0
+        while self.accumulator >= self.step and steps < self.max_steps:
+            # update the sprites in the game
+            self.timed('update_sprites', game.update_sprites)
+
+            # run logic
+            self.timed('run_logic', game.run_logic, windowSurface)
+
+            self.accumulator -= self.step
+            steps += 1
+        if steps == self.max_steps:
+            self.accumulator = min(self.accumulator, self.step)
+
+        # draw the current frame, in between the last two physics steps
+        self.timed('display_frame', game.display_frame, windowSurface, self.accumulator / self.step)
+
+    def timed(self, phase, function, *args):
+        """This function calls function with args, timing it if the game has a profiler"""
+        if self.game.profiler is None:
+            return function(*args)
+        return self.game.profiler.time(phase, function, *args)
+
+def percentile(samples, percent):
+    """This function returns the sample below which percent of the samples fall"""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+def scaled_level(filename, scale):
+    """This function writes a copy of a level with scale times as many raised
+        platforms and coins to a temporary file and returns the file's name. The
+        copies of each platform are spread evenly across the level at its height,
+        and the ground is left alone so the gorges stay where they are"""
+    with open(filename) as level_file:
+        data = json.load(level_file)
+    level_width = data['width']
+    raised = [platform for chunk in data['chunks'] for platform in chunk.get('platforms', [])
+              if platform[3] < GROUND]
+    for copy in range(1, scale):
+        for width, height, x, y in raised:
+            x = (x + copy * level_width // scale) % (level_width - width)
+            data['chunks'][x // data['chunk_width']].setdefault('platforms', []).append([width, height, x, y])
+    data['coins']['count'] *= scale
+    handle, name = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(handle, 'w') as level_file:
+        json.dump(data, level_file)
+    return name
+
+def top_up_creatures(game, count):
+    """This function lets creatures loose just ahead of the window until count of
+        them are alive, so the benchmarks keep the same crowd the whole way through"""
+    while len(game.creatures) < count:
+        if game.spawn_creature(game.camera.x + WINDOWWIDTH + game.rng.randrange(0, WINDOWWIDTH)) is None:
+            return
+
+def benchmark_game(seed, scale, level_file):
+    """This function starts a game for the benchmarks, with scale times the usual
+        creatures in the world and the player running right"""
+    game = Game(seed, sound=False, max_items=MAXITEMS * scale, level_file=level_file)
+    top_up_creatures(game, MAXITEMS * scale)
+    game.handle_event(pygame.event.Event(KEYDOWN, key=K_RIGHT))
+    return game
+
+def run_benchmark(windowSurface, scale, seed=0, steps=BENCHSTEPS):
+    """This function times a game's hot paths at a scale and returns, for each of
+        BENCHPHASES, the time each call took in seconds. The player runs right and
+        jumps every second, the creatures are topped up every step, and a new
+        game is started whenever one is over"""
+    timings = dict((phase, []) for phase in BENCHPHASES)
+    level_file = scaled_level(LEVELFILE, scale)
+    try:
+        # the first game loads the pictures and sounds, which only ever happens
+        # once, so it isn't timed
+        Game(seed, sound=False, max_items=MAXITEMS * scale, level_file=level_file)
+        for i in range(BENCHSTARTS):
+            start = time.perf_counter()
+            Game(seed, sound=False, max_items=MAXITEMS * scale, level_file=level_file)
+            timings['startup'].append(time.perf_counter() - start)
+
+        game = benchmark_game(seed, scale, level_file)
+        probe = Player(0, 0)
+        for step in range(steps):
+            if game.game_over:
+                game = benchmark_game(seed, scale, level_file)
+
+            # replace the creatures that have left the screen or fallen
+            top_up_creatures(game, MAXITEMS * scale)
+            if step % FRAMERATE == 0:
+                pygame.event.post(pygame.event.Event(KEYDOWN, key=K_UP))
+
+            for phase, run in (('process_events', game.process_events),
+                               ('update_sprites', game.update_sprites),
+                               ('run_logic', game.run_logic),
+                               ('display_frame', game.display_frame)):
+                start = time.perf_counter()
+                if phase == 'update_sprites':
+                    run()
+                else:
+                    run(windowSurface)
+                timings[phase].append(time.perf_counter() - start)
+
+            # the collision helpers are timed on a stand-in for the player, so
+            # they don't change the game
+            reach, blocks = platforms_near(game.player, game.platform_index, 0, 0)
+            for phase, collide, args in (
+                    ('platforms_near', platforms_near, (game.platform_index, 0, 0)),
+                    ('gravity', gravity, (game.dt,)),
+                    ('horizontal_collision', horizontal_collision, (blocks,)),
+                    ('vertical_collisions', vertical_collisions, (blocks,)),
+                    ('sense_contacts', sense_contacts, (blocks,))):
+                probe.rect.topleft = game.player.rect.topleft
+                probe.x_change = game.player.x_change
+                probe.y_change = game.player.y_change
+                probe.grounded = game.player.grounded
+                start = time.perf_counter()
+                collide(probe, *args)
+                timings[phase].append(time.perf_counter() - start)
+    finally:
+        os.remove(level_file)
+    return timings
+
+def run_benchmarks(windowSurface, scales=BENCHSCALES, steps=BENCHSTEPS, baseline=None):
+    """This function runs the benchmarks at every scale, prints the p50 and p99
+        times of each phase in milliseconds and returns them as
+        {scale: {phase: {'p50': ms, 'p99': ms}}}. If a baseline is given, phases
+        whose p50 is more than BENCHTOLERANCE times the baseline's are reported as
+        regressions, and the number of them is returned too"""
+    results = {}
+    regressions = 0
+    for scale in scales:
+        timings = run_benchmark(windowSurface, scale, steps=steps)
+        name = '%dx' % scale
+        results[name] = {}
+        print('%s  (%d physics steps)' % (name, steps))
+        print('  %-22s %10s %10s' % ('', 'p50 ms', 'p99 ms'))
+        for phase in BENCHPHASES:
+            p50 = percentile(timings[phase], 50) * 1000
+            p99 = percentile(timings[phase], 99) * 1000
+            results[name][phase] = {'p50': round(p50, 4), 'p99': round(p99, 4)}
+            note = ''
+            if baseline and phase in baseline.get(name, {}):
+                before = baseline[name][phase]['p50']
+                if p50 > before * BENCHTOLERANCE:
+                    note = '  REGRESSION, was %.3f' % before
+                    regressions += 1
+            print('  %-22s %10.3f %10.3f%s' % (phase, p50, p99, note))
+    return results, regressions
+
+class KirbyEnv():
+    """A reset()/step(action) environment around Game for training and evaluating bots.
+        Actions are indexes into ACTIONS and are turned into the same key events a
+        player would send. Observations are numpy feature vectors, or downscaled
+        pixel arrays when pixels is True"""
+    def __init__(self, seed=None, pixels=False, pixel_size=(90, 70), frame_skip=1, seed_step=1):
+        if np is None:
+            raise ImportError('KirbyEnv needs numpy to build observations')
+        self.seed = seed
+
+        # how far the seed moves on for every new episode, so each one is a new game
+        self.seed_step = seed_step
+        self.pixels = pixels
+        self.pixel_size = pixel_size
+        self.frame_skip = frame_skip
+
+        # bots always run without a window or sound
+        if pygame.display.get_surface() is None:
+            setup_pygame(headless=True)
+        self.canvas = pygame.Surface((WINDOWWIDTH, WINDOWHEIGHT))
+        self.game = None
+        self.held_keys = set()
+
+    def reset(self, seed=None):
+        """This function starts a new game and returns the first observation. Unless
+            a seed is given, every episode after the first moves the seed on by
+            seed_step"""
+        if seed is not None:
+            self.seed = seed
+        elif self.game is not None and self.seed is not None:
+            self.seed += self.seed_step
+        self.game = Game(self.seed, sound=False)
+        self.held_keys = set()
+        return self.observe()
+
+    def step(self, action):
+        """This function applies an action, runs the game for frame_skip frames and
+            returns (observation, reward, done, info)"""
+        game = self.game
+        player = game.player
+        keys = ACTIONS[action]
+
+        # release the keys that are no longer held, then press the new ones
+        events = []
+        for key in sorted(self.held_keys):
+            if key not in keys:
+                events.append(pygame.event.Event(KEYUP, key=key))
+                self.held_keys.discard(key)
+        for key in keys:
+            if key == K_UP or key not in self.held_keys:
+                events.append(pygame.event.Event(KEYDOWN, key=key))
+                if key != K_UP:
+                    self.held_keys.add(key)
+
+        points, lives, x = player.points, player.lives, player.rect.x
+        for frame in range(self.frame_skip):
+            for event in events:
+                game.handle_event(event)
+            events = []
+            game.update_sprites()
+            game.run_logic(self.canvas)
+            if game.transition is not None:
+                break
+
+        # the episode is over as soon as the game is decided, without waiting for
+        # the ending to play
+        done = game.transition is not None
+        won = done and player.lives > 0
+        reward = (player.points - points) + (player.rect.x - x) / 100 - (lives - player.lives)
+        if won:
+            reward += 10
+        info = {'frame': game.frame, 'points': player.points,
+                'lives': player.lives, 'x': player.rect.x, 'won': won}
+        return self.observe(), reward, done, info
+
+    def get_state(self):
+        """This function returns the state of the environment, for trying several
+            actions from the same point"""
+        return self.game.snapshot(), set(self.held_keys)
+
+    def set_state(self, state):
+        """This function puts the environment back in a state from get_state"""
+        snapshot, held_keys = state
+        self.game.restore(snapshot)
+        self.held_keys = set(held_keys)
+
+    def observe(self):
+        """This function returns the observation of the current game"""
+        if self.pixels:
+            self.game.draw(self.canvas)
+            small = pygame.transform.smoothscale(self.canvas, self.pixel_size)
+            return pygame.surfarray.array3d(small).transpose(1, 0, 2)
+        return self.features()
+
+    def features(self):
+        """This function describes the game around the player as a float32 vector"""
+        game = self.game
+        player = game.player
+        view = pygame.Rect(player.rect.x - OBSERVEDRANGE, 0, OBSERVEDRANGE * 2, WINDOWHEIGHT)
+
+        def nearest(index, count):
+            """returns the positions of the closest sprites relative to the player"""
+            found = sorted(index.query(view), key=lambda s: abs(s.rect.centerx - player.rect.centerx))
+            values = []
+            for sprite in found[:count]:
+                values += [(sprite.rect.centerx - player.rect.centerx) / OBSERVEDRANGE,
+                           (sprite.rect.centery - player.rect.centery) / WINDOWHEIGHT]
+            return values + [0.0, 0.0] * (count - len(found[:count]))
+
+        # how far the ground under the player reaches in front of them
+        ground = 0.0
+        for block in game.platform_index.query(view):
+            if block.rect.top == GROUND and block.rect.left <= player.rect.centerx < block.rect.right:
+                ground = (block.rect.right - player.rect.centerx) / OBSERVEDRANGE
+
+        values = [player.rect.x / MAXBG, player.rect.y / WINDOWHEIGHT,
+                  player.x_change / RUNSPEED, player.y_change / -JUMPSPEED,
+                  player.lives, player.points, game.camera.x / MAXBG, ground]
+        values += nearest(game.creature_index, OBSERVEDCREATURES)
+        values += nearest(game.powerup_index, 1)
+        values += nearest(game.coin_index, 1)
+        values += nearest(game.plant_index, 1)
+        values += nearest(game.platform_index, 2)
+        values += nearest(game.win_index, 1)
+        return np.array(values, dtype=np.float32)
+
+def env_worker(connection, seeds, pixels, pixel_size, frame_skip, seed_step):
+    """This function runs a shard of environments in a worker process and answers
+        commands sent down the pipe"""
+    envs = [KirbyEnv(seed, pixels, pixel_size, frame_skip, seed_step) for seed in seeds]
+    while True:
+        command, data = connection.recv()
+        if command == 'reset':
+            connection.send([env.reset() for env in envs])
+        elif command == 'step':
+            results = []
+            for env, action in zip(envs, data):
+                observation, reward, done, info = env.step(action)
+                # start the next game straight away, like most vectorised environments
+                if done:
+                    info['final_observation'] = observation
+                    observation = env.reset()
+                results.append((observation, reward, done, info))
+            connection.send(results)
+        elif command == 'close':
+            connection.close()
+            return
+
+class VecKirbyEnv():
+    """Runs many KirbyEnv instances sharded across worker processes and batches their
+        observations, rewards and done flags into numpy arrays"""
+    def __init__(self, num_envs, num_workers=None, seed=0, pixels=False,
+                 pixel_size=(90, 70), frame_skip=1):
+        if np is None:
+            raise ImportError('VecKirbyEnv needs numpy to batch observations')
+        self.num_envs = num_envs
+        num_workers = min(num_workers or multiprocessing.cpu_count(), num_envs)
+
+        # give every worker a contiguous slice of the environments. Each episode
+        # moves an environment's seed on by num_envs, so no two games are the same
+        seeds = [seed + i for i in range(num_envs)]
+        size, extra = divmod(num_envs, num_workers)
+        self.shards = []
+        start = 0
+        for worker in range(num_workers):
+            end = start + size + (1 if worker < extra else 0)
+            self.shards.append((start, end))
+            start = end
+
+        # spawn fresh interpreters so no SDL state is shared with the parent. They
+        # import env_worker by its module's name, so bots import this file as
+        # kirby_env rather than loading it by path
+        context = multiprocessing.get_context('spawn')
+        self.connections = []
+        self.workers = []
+        for start, end in self.shards:
+            parent, child = context.Pipe()
+            worker = context.Process(target=env_worker, daemon=True,
+                                     args=(child, seeds[start:end], pixels, pixel_size, frame_skip,
+                                           num_envs))
+            worker.start()
+            child.close()
+            self.connections.append(parent)
+            self.workers.append(worker)
+
+    def reset(self):
+        """This function resets every environment and returns the batched observations"""
+        for connection in self.connections:
+            connection.send(('reset', None))
+        observations = []
+        for connection in self.connections:
+            observations += connection.recv()
+        return np.stack(observations)
+
+    def step(self, actions):
+        """This function steps every environment with its action and returns batched
+            (observations, rewards, dones, infos)"""
+        for connection, (start, end) in zip(self.connections, self.shards):
+            connection.send(('step', [int(action) for action in actions[start:end]]))
+        results = []
+        for connection in self.connections:
+            results += connection.recv()
+        observations, rewards, dones, infos = zip(*results)
+        return (np.stack(observations), np.array(rewards, dtype=np.float32),
+                np.array(dones, dtype=bool), list(infos))
+
+    def close(self):
+        """This function shuts down the worker processes"""
+        for connection in self.connections:
+            connection.send(('close', None))
+        for worker in self.workers:
+            worker.join()
+
+def parse_args(argv=None):
+    """This function reads the command line options"""
+    parser = argparse.ArgumentParser(description='Run Kirby Run!')
+    parser.add_argument('--headless', action='store_true',
+                        help='simulate the game without a window or sound, uncapped')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for the coin, creature and star placement')
+    parser.add_argument('--frames', type=int, default=FRAMERATE * 60,
+                        help='the number of physics steps to simulate in headless mode')
+    parser.add_argument('--level', default=LEVELFILE,
+                        help='the level file to play')
+    parser.add_argument('--endless', action='store_true',
+                        help='play an endless, randomly generated level instead')
+    parser.add_argument('--batch', action='store_true',
+                        help='keep creatures, coins and stars in numpy arrays (needs numpy)')
+    parser.add_argument('--swarm', type=int, default=1,
+                        help='creatures and stars in every wave, for stress testing (needs numpy)')
+    parser.add_argument('--max-items', type=int, default=MAXITEMS,
+                        help='the most creatures, and the most stars, alive at once')
+    parser.add_argument('--sim-rate', type=int, default=SIMRATE,
+                        help='the number of physics steps per second')
+    parser.add_argument('--fps', type=int, default=FRAMERATE,
+                        help='the most frames drawn per second (0 for no limit)')
+    parser.add_argument('--dirty', action='store_true',
+                        help='only redraw the parts of the window that change')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='time the game loop headless at 1x, 10x and 100x scale')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare the benchmarks with the timings saved in FILE '
+                             '(default: %s, if it exists)' % BENCHBASELINE)
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help='save the benchmark timings to FILE')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='save the time each part of every frame took to FILE on exit (.csv or .json)')
+    parser.add_argument('--build-nav', action='store_true',
+                        help="work out which platforms can reach which, save it next to the level "
+                             "and check the level can be finished")
+    parser.add_argument('--record', metavar='FILE',
+                        help='save the game as a replay file')
+    parser.add_argument('--replay', metavar='FILE', nargs='+',
+                        help='play replay files back headless and check their final state')
+    parser.add_argument('--capture', metavar='PATH',
+                        help='save the game\'s frames as a raw RGB video if PATH ends in .raw, '
+                             'or as numbered PNG images in the folder PATH')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """The mainline for the game"""
+    args = parse_args(argv)
+
+    # work out the level's navigation graph, and fail if it can't be finished
+    if args.build_nav:
+        start = time.time()
+        if args.endless:
+            # the same level a game with this seed would generate
+            seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+            nav = NavGraph.for_endless(EndlessLevel(random.Random(seed).randrange(1 << 32)))
+            name = 'endless level %d, first %d chunks' % (seed, NAVCHUNKS)
+        else:
+            nav = NavGraph.for_level(Level.load(args.level, random.Random(0)))
+            name = nav_file(args.level)
+            nav.save(name)
+        print('%s: %d nodes  %d edges  %s  (%.1f ms)'
+              % (name, len(nav.nodes), sum(len(targets) for targets in nav.edges),
+                 'can be finished' if nav.solvable() else 'CAN NOT be finished',
+                 (time.time() - start) * 1000))
+        if not nav.solvable():
+            raise SystemExit(1)
+        return
+
+    # set up pygame and the windowSurface
+    windowSurface = setup_pygame(args.headless or args.benchmark or bool(args.replay))
+
+    # time the hot paths, and fail if they got slower than the baseline
+    if args.benchmark:
+        baseline = None
+        baseline_name = args.baseline
+        if baseline_name is None and os.path.exists(BENCHBASELINE):
+            baseline_name = BENCHBASELINE
+        if baseline_name:
+            with open(baseline_name) as baseline_file:
+                baseline = json.load(baseline_file)
+        results, regressions = run_benchmarks(windowSurface, baseline=baseline)
+        if args.save_baseline:
+            with open(args.save_baseline, 'w') as baseline_file:
+                json.dump(results, baseline_file, indent=4)
+        if regressions:
+            raise SystemExit(1)
+        return
+
+    # play the replays back and fail if any of them ends differently
+    if args.replay:
+        failed = 0
+        for filename in args.replay:
+            # with several replays, each one is captured under its own name
+            capture = args.capture
+            if capture and len(args.replay) > 1:
+                root, extension = os.path.splitext(capture)
+                capture = '%s-%s%s' % (root, os.path.splitext(os.path.basename(filename))[0], extension)
+            start = time.time()
+            game, expected = run_replay(windowSurface, filename, capture)
+            elapsed = time.time() - start
+            matches = game_state(game) == expected
+            failed += not matches
+            print('%s: steps: %d  frames: %d  points: %d  lives: %d  x: %d  %s  (%.0f steps/s)'
+                  % (filename, game.steps, game.frame, game.player.points, game.player.lives,
+                     game.player.rect.x, 'ok' if matches else 'MISMATCH, expected %s' % (expected,),
+                     game.steps / max(elapsed, 1e-9)))
+        if failed:
+            raise SystemExit(1)
+        return
+
+    if args.headless:
+        start = time.time()
+        game = run_headless(windowSurface, args.frames, args.seed, args.max_items,
+                            args.sim_rate, args.level, args.endless, args.batch, args.swarm,
+                            args.record, args.capture)
+        elapsed = time.time() - start
+        print('frames: %d  points: %d  lives: %d  x: %d  (%.0f frames/s)'
+              % (game.frame, game.player.points, game.player.lives, game.player.rect.x,
+                 game.frame / max(elapsed, 1e-9)))
+        return
 
-main()
+    mainClock = pygame.time.Clock()
 
+    # times the game's frames. The overlay is shown with PROFILEKEY
+    profiler = FrameProfiler()
+    if args.profile:
+        profiler.save_on_exit(args.profile)
+
+    # saves every frame of the game that is drawn, dropping frames rather
+    # than slowing the game down if the disk can't keep up
+    capture = None
+    if args.capture:
+        capture = FrameCapture(args.capture, windowSurface)
+
+    # load the game's assets in the background while the menu is up
+    preloader = AssetPreloader(ASSETS)
+    progress = 0.0
+
+    # the menus and the game share one loop. The menus sleep until an event
+    # arrives, while the game runs a frame every time around
+    screen = MENU
+    allow_events(MENUEVENTS)
+    display_screen(screen, windowSurface, progress)
+    game = None
+    timestep = None
+    while True:
+        if screen == PLAYING:
+            timestep.run_frame(windowSurface)
+            if capture is not None:
+                capture.capture(windowSurface)
+
+            # keep the clock going
+            profiler.time('tick', mainClock.tick, args.fps)
+            profiler.end_frame(game)
+
+            # go back to the menu when the user restarts
+            if game.restart:
+                if game.recorder is not None:
+                    game.recorder.save()
+                screen = MENU
+                allow_events(MENUEVENTS)
+                display_screen(screen, windowSurface)
+            continue
+
+        # while the assets load, wake up often to store them and show progress
+        if preloader is not None:
+            progress = preloader.poll()
+            if progress == 1:
+                preloader = None
+            display_screen(screen, windowSurface, progress)
+            event = pygame.event.wait(PRELOADWAIT)
+        else:
+            event = pygame.event.wait(MENUWAIT)
+        if event.type == NOEVENT:
+            continue
+        if event.type == VIDEOEXPOSE:
+            display_screen(screen, windowSurface, progress)
+            continue
+
+        # display the menu screen and get user input
+        if screen == MENU:
+            next_screen = menu_input(event)
+        else:
+            next_screen = user_input(event)
+        if next_screen is None:
+            continue
+
+        screen = next_screen
+        if screen == PLAYING:
+            # the game can't start until everything has loaded
+            if preloader is not None:
+                preloader.finish()
+                preloader = None
+
+            # instantiate a game
+            allow_events(GAMEEVENTS)
+            game = Game(args.seed, dirty_rects=args.dirty, max_items=args.max_items,
+                        sim_rate=args.sim_rate, level_file=args.level,
+                        endless=args.endless, batch=args.batch, swarm=args.swarm)
+            if args.record:
+                ReplayRecorder(game, args.record)
+            profiler.attach(game)
+            timestep = FixedTimestep(game, args.fps)
+        else:
+            display_screen(screen, windowSurface)
 
+if __name__ == '__main__':
+    main()
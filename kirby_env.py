@@ -0,0 +1,15 @@
+# This module lets bots import the game, whose file name can't be imported.
+# Use it like this, from the game's folder so the pictures and sounds are found:
+#
+#     from kirby_env import KirbyEnv, VecKirbyEnv, ACTIONS
+#
+# The game's code runs as this module, so the worker processes of VecKirbyEnv
+# can find env_worker again by importing kirby_env
+
+import os
+
+# the game's file, next to this one
+GAMEFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'FINAL GAME 2022.py')
+
+with open(GAMEFILE) as game_file:
+    exec(compile(game_file.read(), GAMEFILE, 'exec'))